@@ -0,0 +1,54 @@
+import os, sys, json, time, argparse
+
+# Plays a video in the player without a display (QT_QPA_PLATFORM=offscreen) and prints the timer and speech
+# statistics as one JSON line. Run by run.py in its own process.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("video")
+	parser.add_argument("--seconds", type=float, default=10.0)
+	parser.add_argument("--rate", type=float, default=1.0)
+	args = parser.parse_args()
+
+	started = time.perf_counter()
+	from PySide2.QtCore import QTimer
+	from PySide2.QtWidgets import QApplication
+	import commentplayer
+	app = QApplication(sys.argv[:1])
+	imported = time.perf_counter()
+	player = commentplayer.VideoPlayer(args.video, playbackRate=args.rate)
+	player.show()
+	created = time.perf_counter()
+
+	# Count the scheduler's wake-ups
+	wakeups = []
+	updatePlayback = player.updatePlayback
+	def countedUpdatePlayback():
+		wakeups.append(player.mediaPlayer.position())
+		updatePlayback()
+	player.updatePlayback = countedUpdatePlayback
+
+	def finish():
+		result = {
+			"import_seconds": imported - started,
+			"startup_seconds": created - imported,
+			"played_seconds": args.seconds,
+			"position_ms": player.mediaPlayer.position(),
+			"wakeups": len(wakeups),
+			"comments_shown": player.nextCommentIndex,
+			"comment_timing_ms": player.scheduler.stats(),
+			"voice_start_ms": player.voiceOutput.stats(),
+			"speech_requests": {"synthesized": player.speechQueue.synthesized, "dropped": player.speechQueue.dropped},
+		}
+		player.close()
+		print(json.dumps(result))
+		app.quit()
+
+	player.play()
+	QTimer.singleShot(int(args.seconds * 1000), finish)
+	app.exec_()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,198 @@
+import os, sys, json, time, shutil, argparse, platform, tempfile, subprocess, importlib.util
+from contextlib import redirect_stdout
+
+# Offline benchmarks for generate_movie.py and the player against a local VOICEVOX stub, on synthetic projects.
+# Results are written as JSON so that runs of different versions can be compared.
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from voicevox_stub import start_stub
+from synthetic import SIZES, write_project
+
+# What each mode of the two programs imports before it starts working; the heavy modules are loaded on first use
+STARTUP_MODES = {
+	"python": "pass",
+	"generate_movie": "import generate_movie",
+	"audio": "import generate_movie, ffmpeg",
+	"export": "import generate_movie, render, voicevox, mixdown, textnorm; textnorm.alpha_to_kana('')",
+	"moviepy": "import generate_movie, caption_clip, captions, trajectory, voicevox, mixdown, textnorm",
+	"player": "import commentplayer",
+}
+
+# Benchmarks that do not use the synthetic project
+WITHOUT_PROJECT = {"startup"}
+
+BENCHMARKS = ["startup", "generate_wav", "draw_trajectory", "create_text_image", "process_video_speed_and_offsets", "export", "player"]
+
+def timed(function, *args, **kwargs):
+	started = time.perf_counter()
+	result = function(*args, **kwargs)
+	return time.perf_counter() - started, result
+
+def bench_startup(project, args):
+	# Cold start of each mode in a fresh interpreter, best of a few runs; "python" is the interpreter on its own
+	result = {}
+	for mode, statement in STARTUP_MODES.items():
+		if mode == "player" and importlib.util.find_spec("PySide2") is None:
+			result[mode] = {"skipped": "No module named 'PySide2'"}
+			continue
+		runs, error = [], None
+		for _ in range(args.startup_runs):
+			seconds, process = timed(subprocess.run, [sys.executable, "-c", statement], cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+			if process.returncode != 0:
+				error = process.stderr.decode("utf-8", "replace").strip().splitlines()[-1]
+				break
+			runs.append(seconds)
+		result[mode] = {"error": error} if error else min(runs)
+	return result
+
+def bench_generate_wav(project, args):
+	from timeline import load_plan
+	from voicevox import SynthesisCache
+	from generate_movie import generate_wav
+	plan = load_plan(project["comments"])
+	cache = SynthesisCache(tempfile.mkdtemp(prefix="voice-", dir=args.work))
+	cold, (segments, _) = timed(generate_wav, project["video"], plan.adjusted, 1.0, cache=cache, jobs=args.jobs)
+	warm, _ = timed(generate_wav, project["video"], plan.adjusted, 1.0, cache=cache, jobs=args.jobs)
+	return {"seconds": cold, "cached_seconds": warm, "segments": len(segments), "comments": len(plan.adjusted)}
+
+def bench_draw_trajectory(project, args):
+	import numpy as np
+	from trajectory import TrajectoryRenderer
+	from generate_movie import draw_trajectory
+	frame = np.zeros((project["height"], project["width"], 3), dtype=np.uint8)
+	renderer = TrajectoryRenderer(project["trajectory"], project["clear_events"])
+	frames = int(project["seconds"] * project["fps"])
+	started = time.perf_counter()
+	for i in range(frames):
+		draw_trajectory(frame, i / project["fps"], project["trajectory"], project["clear_events"], renderer)
+	seconds = time.perf_counter() - started
+	return {"seconds": seconds, "frames": frames, "ms_per_frame": 1000 * seconds / frames}
+
+def bench_create_text_image(project, args):
+	from timeline import load_plan
+	from captions import TTF_FONTFILE, FONT_SIZE, load_font
+	from generate_movie import create_text_image
+	font = load_font(args.font or TTF_FONTFILE, args.font_size or FONT_SIZE)
+	texts = [entry.display for entry in load_plan(project["comments"]).adjusted]
+	cold, _ = timed(lambda: [create_text_image(text, project["width"], project["height"], font) for text in texts])
+	warm, _ = timed(lambda: [create_text_image(text, project["width"], project["height"], font) for text in texts])
+	return {"seconds": cold, "cached_seconds": warm, "captions": len(texts)}
+
+def bench_process_video_speed_and_offsets(project, args):
+	from moviepy.editor import VideoFileClip
+	from generate_movie import process_video_speed_and_offsets
+	video = VideoFileClip(project["video"], audio=False)
+	seconds, (clip, adjusted) = timed(process_video_speed_and_offsets, video, project["comments"])
+	# Pull a frame per second of output through the speed segments
+	times = [t for t in range(int(clip.duration))]
+	frame_seconds, _ = timed(lambda: [clip.get_frame(t) for t in times])
+	video.close()
+	return {"seconds": seconds, "frames": len(times), "frame_seconds": frame_seconds, "duration": clip.duration}
+
+def bench_export(project, args):
+	# The whole export in a fresh process, with empty caches and then again with the caches of the first run
+	env = dict(os.environ)
+	caches = tempfile.mkdtemp(prefix="caches-", dir=args.work)
+	env["XDG_CACHE_HOME"] = caches
+	for name in ("VOICE", "CAPTION", "PLAN", "RENDER"):
+		env.pop("COMMENTPLAYER_%s_CACHE" % name, None)
+	metrics_filename = os.path.join(args.work, "export-metrics.json")
+	command = [sys.executable, os.path.join(REPO_DIR, "generate_movie.py"), project["video"], "--engine", args.engine, "--jobs", str(args.jobs),
+			   "--quiet", "--metrics", metrics_filename]
+	result = {"engine": args.engine}
+	for run in ("seconds", "cached_seconds"):
+		seconds, process = timed(subprocess.run, command, env=env, cwd=args.work, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+		if process.returncode != 0:
+			raise RuntimeError(process.stderr.decode("utf-8", "replace")[-2000:])
+		result[run] = seconds
+		# Where the time went, as reported by generate_movie.py itself
+		with open(metrics_filename, encoding="utf-8") as f:
+			result[run.replace("seconds", "metrics")] = json.load(f)
+	return result
+
+def bench_player(project, args):
+	if importlib.util.find_spec("PySide2") is None:
+		raise ImportError("No module named 'PySide2'")
+	env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+	command = [sys.executable, os.path.join(BENCHMARK_DIR, "player.py"), project["video"], "--seconds", str(min(args.player_seconds, project["seconds"]))]
+	seconds, process = timed(subprocess.run, command, env=env, cwd=args.work, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=args.player_seconds + 120)
+	if process.returncode != 0:
+		raise RuntimeError(process.stderr.decode("utf-8", "replace")[-2000:])
+	result = json.loads(process.stdout.decode("utf-8").strip().splitlines()[-1])
+	result["seconds"] = seconds
+	return result
+
+def git_commit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark commentplayer offline")
+	parser.add_argument("--sizes", default="small,medium", help="comma separated, from %s" % ",".join(SIZES))
+	parser.add_argument("--only", default=",".join(BENCHMARKS), help="comma separated benchmarks to run")
+	parser.add_argument("--output", help="JSON file for the results (default: standard output)")
+	parser.add_argument("--work", help="directory for the synthetic projects and caches (default: a temporary one)")
+	parser.add_argument("--keep", action="store_true", help="keep the work directory")
+	parser.add_argument("--query-latency", type=float, default=0.01, help="stub seconds per /audio_query")
+	parser.add_argument("--synthesis-latency", type=float, default=0.05, help="stub seconds per /synthesis")
+	parser.add_argument("--synthesis-factor", type=float, default=0.0, help="stub seconds per second of audio")
+	parser.add_argument("--jobs", type=int, default=4)
+	parser.add_argument("--engine", default="chunks")
+	parser.add_argument("--player-seconds", type=float, default=10.0)
+	parser.add_argument("--startup-runs", type=int, default=3, help="fresh processes per mode for the startup benchmark")
+	parser.add_argument("--font", default=None, help="font for the captions (default: the one generate_movie.py uses)")
+	parser.add_argument("--font-size", type=int, default=None)
+	args = parser.parse_args()
+
+	stub = start_stub(query_latency=args.query_latency, synthesis_latency=args.synthesis_latency, synthesis_factor=args.synthesis_factor)
+	# Read by voicevox.py at import time, and inherited by the export and player processes
+	os.environ["VOICEVOX_SERVER"] = stub.url
+	temporary = args.work is None
+	if temporary:
+		args.work = tempfile.mkdtemp(prefix="commentplayer-bench-")
+	os.environ["XDG_CACHE_HOME"] = os.path.join(args.work, "cache")
+
+	report = {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+			  "cpus": os.cpu_count(), "stub": {"query_latency": args.query_latency, "synthesis_latency": args.synthesis_latency,
+			  "synthesis_factor": args.synthesis_factor}, "results": {}}
+	try:
+		for size in args.sizes.split(","):
+			results = report["results"][size] = {}
+			try:
+				project, missing = write_project(os.path.join(args.work, "projects"), size), None
+			except Exception as e:
+				# Without ffmpeg there is no test video: only the benchmarks that do not need one run
+				project, missing = None, "no synthetic project: %s: %s" % (type(e).__name__, e)
+			for name in args.only.split(","):
+				print("%s: %s" % (size, name), file=sys.stderr)
+				if project is None and name not in WITHOUT_PROJECT:
+					results[name] = {"skipped": missing}
+					continue
+				try:
+					# What the programs print would get mixed into the report
+					with redirect_stdout(sys.stderr):
+						results[name] = globals()["bench_" + name](project, args)
+				except ImportError as e:
+					results[name] = {"skipped": str(e)}
+				except Exception as e:
+					results[name] = {"error": "%s: %s" % (type(e).__name__, e)}
+		report["stub"]["requests"] = stub.requests
+	finally:
+		stub.shutdown()
+		if temporary and not args.keep:
+			shutil.rmtree(args.work, ignore_errors=True)
+
+	output = json.dumps(report, indent=2, ensure_ascii=False)
+	if args.output:
+		with open(args.output, "w", encoding="utf-8") as f:
+			f.write(output + "\n")
+	else:
+		print(output)
+
+if __name__ == "__main__":
+	main()
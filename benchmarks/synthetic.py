@@ -0,0 +1,76 @@
+import os, random
+import ffmpeg
+
+# Synthetic projects: a test pattern video with comments and a trajectory drawn over it
+SIZES = {
+	"small": {"seconds": 10, "comments": 20, "strokes": 10},
+	"medium": {"seconds": 60, "comments": 200, "strokes": 100},
+	"large": {"seconds": 300, "comments": 2000, "strokes": 1000},
+}
+
+WORDS = ["今日は", "いい天気", "ですね", "この", "シーン", "が", "好き", "です", "Python", "GPU", "frame", "なるほど",
+		 "{字幕|じまく}", "{音声|おんせい}", "ここ", "見て", "ください", "test"]
+
+def make_video(filename, seconds, width=640, height=360, fps=30):
+	(ffmpeg.input("testsrc=size=%dx%d:rate=%d" % (width, height, fps), f="lavfi", t=seconds)
+		.output(filename, vcodec="libx264", pix_fmt="yuv420p", preset="ultrafast")
+		.global_args("-loglevel", "error")
+		.overwrite_output()
+		.run())
+	return filename
+
+def make_comments(count, duration_ms, seed=0):
+	# [(offset ms, text)] sorted by offset, with a few speed changes, skipped zones and "---" splits among them
+	rng = random.Random(seed)
+	offsets = sorted(rng.sample(range(0, duration_ms), count))
+	comments = []
+	for i, offset in enumerate(offsets):
+		if i % 50 == 10:
+			text = rng.choice([">>", ">>>", "<<"])
+		elif i % 50 == 20:
+			text = ">"
+		elif i % 100 == 30:
+			text = "["
+		elif i % 100 == 33:
+			text = "]"
+		else:
+			text = "".join(rng.choice(WORDS) for _ in range(rng.randint(2, 8)))
+			if rng.random() < 0.1:
+				text += "---" + "".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5)))
+		comments.append((offset, text))
+	return comments
+
+def make_trajectory(strokes, duration_ms, points_per_stroke=30, strokes_per_clear=5, seed=0):
+	# Points (start time, time, x, y) with x and y in [-0.5, 0.5], and a clear event after every few strokes
+	rng = random.Random(seed)
+	trajectory = []
+	clear_events = []
+	starts = sorted(rng.sample(range(0, max(1, duration_ms - points_per_stroke * 40)), strokes))
+	for i, start in enumerate(starts):
+		x, y = rng.uniform(-0.4, 0.4), rng.uniform(-0.4, 0.4)
+		for j in range(points_per_stroke):
+			x = min(0.5, max(-0.5, x + rng.uniform(-0.02, 0.02)))
+			y = min(0.5, max(-0.5, y + rng.uniform(-0.02, 0.02)))
+			trajectory.append((start, start + j * 40, x, y))
+		if i % strokes_per_clear == strokes_per_clear - 1:
+			clear_events.append(start + points_per_stroke * 40 + 100)
+	return trajectory, clear_events
+
+def write_project(directory, size, seed=0, width=640, height=360, fps=30):
+	# A video with its .comments.json and trajectory sidecar, as the player saves them
+	from journal import write_snapshot, journal_filename
+	from trajectory_store import TrajectoryStore
+	spec = SIZES[size]
+	os.makedirs(directory, exist_ok=True)
+	video_filename = os.path.join(directory, "%s.mp4" % size)
+	if not os.path.exists(video_filename):
+		make_video(video_filename, spec["seconds"], width, height, fps)
+	duration_ms = spec["seconds"] * 1000
+	comments = make_comments(spec["comments"], duration_ms, seed)
+	trajectory, clear_events = make_trajectory(spec["strokes"], duration_ms, seed=seed)
+	comments_filename = video_filename + ".comments.json"
+	write_snapshot(comments_filename, comments, TrajectoryStore(trajectory), clear_events, 0)
+	if os.path.exists(journal_filename(comments_filename)):
+		os.unlink(journal_filename(comments_filename))  # Left by an earlier player run
+	return {"video": video_filename, "comments": comments, "trajectory": trajectory, "clear_events": clear_events,
+			"width": width, "height": height, "fps": fps, "seconds": spec["seconds"]}
@@ -0,0 +1,91 @@
+import sys, json, time, struct, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Stand-in for the VOICEVOX engine: answers /version, /audio_query and /synthesis with silent WAV audio
+# whose length follows the text, after a configurable delay.
+SAMPLE_RATE = 24000
+SECONDS_PER_CHARACTER = 0.12
+
+def silent_wav(seconds, rate=SAMPLE_RATE):
+	frames = int(seconds * rate)
+	header = struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + frames * 2, b"WAVE", b"fmt ", 16, 1, 1, rate, rate * 2, 2, 16, b"data", frames * 2)
+	return header + bytes(frames * 2)
+
+class StubHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"  # keep-alive, like the engine
+
+	def log_message(self, format, *args):
+		pass
+
+	def reply(self, body, content_type):
+		self.send_response(200)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		if urlparse(self.path).path == "/version":
+			self.reply(json.dumps("stub").encode("utf-8"), "application/json")
+		else:
+			self.send_error(404)
+
+	def do_POST(self):
+		url = urlparse(self.path)
+		length = int(self.headers.get("Content-Length") or 0)
+		body = self.rfile.read(length) if length else b""
+		server = self.server
+		with server.lock:
+			server.requests[url.path] = server.requests.get(url.path, 0) + 1
+		if url.path == "/audio_query":
+			time.sleep(server.query_latency)
+			text = parse_qs(url.query).get("text", [""])[0]
+			query = {"accent_phrases": [], "speedScale": 1.0, "pitchScale": 0.0, "intonationScale": 1.0, "volumeScale": 1.0,
+					 "prePhonemeLength": 0.1, "postPhonemeLength": 0.1, "outputSamplingRate": SAMPLE_RATE, "outputStereo": False, "kana": text}
+			self.reply(json.dumps(query, ensure_ascii=False).encode("utf-8"), "application/json")
+		elif url.path == "/synthesis":
+			query = json.loads(body or b"{}")
+			seconds = (0.2 + len(query.get("kana", "")) * SECONDS_PER_CHARACTER) / (query.get("speedScale") or 1.0)
+			time.sleep(server.synthesis_latency + seconds * server.synthesis_factor)
+			self.reply(silent_wav(seconds), "audio/wav")
+		else:
+			self.send_error(404)
+
+class StubServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, query_latency=0.0, synthesis_latency=0.0, synthesis_factor=0.0):
+		super().__init__(address, StubHandler)
+		self.query_latency = query_latency  # seconds per /audio_query
+		self.synthesis_latency = synthesis_latency  # seconds per /synthesis
+		self.synthesis_factor = synthesis_factor  # extra seconds per second of synthesized audio
+		self.requests = {}
+		self.lock = threading.Lock()
+
+	@property
+	def url(self):
+		return "http://%s:%d" % self.server_address[:2]
+
+def start_stub(port=0, **latency):
+	# Serve on a background thread; port 0 picks a free port
+	server = StubServer(("127.0.0.1", port), **latency)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def main():
+	parser = argparse.ArgumentParser(description="Local stand-in for the VOICEVOX engine")
+	parser.add_argument("--port", type=int, default=50021)
+	parser.add_argument("--query-latency", type=float, default=0.0, help="seconds per /audio_query")
+	parser.add_argument("--synthesis-latency", type=float, default=0.0, help="seconds per /synthesis")
+	parser.add_argument("--synthesis-factor", type=float, default=0.0, help="extra seconds per second of audio")
+	args = parser.parse_args()
+	server = StubServer(("127.0.0.1", args.port), args.query_latency, args.synthesis_latency, args.synthesis_factor)
+	print("VOICEVOX stub on %s" % server.url, file=sys.stderr)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,11 @@
+from moviepy.editor import VideoClip
+
+class LazyCaptionClip(VideoClip):
+	# Caption clip cropped to the text; frames come from a CaptionSource instead of a full-frame ImageClip
+	def __init__(self, source, index, size, duration, ismask=False):
+		VideoClip.__init__(self, ismask=ismask, duration=duration)
+		self.size = size
+		if ismask:
+			self.make_frame = lambda t: source.mask(index, t)
+		else:
+			self.make_frame = lambda t: source.frame(index, t)
@@ -0,0 +1,298 @@
+import os, hashlib, threading
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from PIL.PngImagePlugin import PngInfo
+from textnorm import wakati
+from metrics import log
+
+TTF_FONTFILE='/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc'
+FONT_SIZE = 50
+OUTLINE_WIDTH = 3
+# Bump when the look of captions changes so that cached bitmaps are re-rendered
+RENDER_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.environ.get("COMMENTPLAYER_CAPTION_CACHE",
+	os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "commentplayer", "captions"))
+DEFAULT_CACHE_SIZE = int(os.environ.get("COMMENTPLAYER_CAPTION_CACHE_SIZE", 256 * 1024 * 1024))
+MEMORY_CACHE_ENTRIES = 32
+
+_fonts = {}
+_measure = ImageDraw.Draw(Image.new('L', (1, 1)))
+
+def load_font(font_path=TTF_FONTFILE, size=FONT_SIZE):
+	key = (font_path, size)
+	if key not in _fonts:
+		_fonts[key] = ImageFont.truetype(font_path, size)
+	return _fonts[key]
+
+def wrap_text(text, max_width, font):
+	# Wrap at spaces, or at MeCab word boundaries for lines without spaces
+	wrapped_text = ""
+	for line in text.split('\n'):
+		line_width = _measure.textbbox((0, 0), line, font=font)[2]
+		if line_width <= max_width:
+			wrapped_text += line + "\n"
+		else:
+			delimiter = ' '
+			words = line.split(delimiter)
+			if len(words) == 1:
+				words = wakati(line).split(delimiter)
+				delimiter = ''
+			current_line = ""
+			for word in words:
+				word_width = _measure.textbbox((0, 0), current_line + word + delimiter, font=font)[2]
+				if word_width <= max_width:
+					current_line += word + delimiter
+				else:
+					wrapped_text += current_line + '\n'
+					current_line = word + delimiter
+			wrapped_text += current_line + '\n'
+	return wrapped_text.split('\n')
+
+def draw_caption(text, width, font):
+	# Returns the caption as a tight RGBA bitmap, its x position and its top edge measured up from the bottom of the frame
+	lines = wrap_text(text, width, font)
+	log(2, "%r", lines)
+
+	boxes = [_measure.textbbox((0, 0), line, font=font) for line in lines]
+	total_text_height = sum(box[3] for box in boxes)
+	top = total_text_height + OUTLINE_WIDTH
+	image = Image.new('RGBA', (width, top), (0, 0, 0, 0))
+	draw = ImageDraw.Draw(image)
+
+	y_text = OUTLINE_WIDTH
+	for line, text_size in zip(lines, boxes):
+		text_pos = ((width - text_size[2]) // 2, y_text)
+		# White text with a black edge, rasterized in a single pass
+		draw.text(text_pos, line, font=font, fill=(255, 255, 255, 255), stroke_width=OUTLINE_WIDTH, stroke_fill=(0, 0, 0, 255))
+		y_text += text_size[3]
+
+	box = image.getbbox()
+	if box is None:
+		return np.zeros((0, 0, 4), dtype=np.uint8), 0, 0
+	return np.array(image.crop(box)), box[0], top - box[1]
+
+class CaptionCache:
+	# Finished caption bitmaps, kept in memory (LRU) and as PNG files on disk across exports. Least recently used
+	# PNG files are deleted once the disk cache grows past max_bytes.
+	def __init__(self, directory=DEFAULT_CACHE_DIR, entries=MEMORY_CACHE_ENTRIES, max_bytes=DEFAULT_CACHE_SIZE):
+		self.directory = directory
+		self.entries = entries
+		self.max_bytes = max_bytes
+		self.memory = OrderedDict()
+		self.lock = threading.Lock()
+		os.makedirs(directory, exist_ok=True)
+
+	def key(self, text, font_path, size, width):
+		source = "\0".join([str(RENDER_VERSION), text, os.path.abspath(font_path), str(size), str(width)])
+		return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key[:2], key + ".png")
+
+	def get(self, key):
+		with self.lock:
+			if key in self.memory:
+				self.memory.move_to_end(key)
+				return self.memory[key]
+		path = self.path(key)
+		try:
+			with Image.open(path) as image:
+				caption = (np.array(image.convert('RGBA')), int(image.info["x"]), int(image.info["bottom"]))
+			os.utime(path)  # mtime doubles as the LRU timestamp
+		except (OSError, KeyError, ValueError):
+			return None
+		self.remember(key, caption)
+		return caption
+
+	def remember(self, key, caption):
+		with self.lock:
+			self.memory[key] = caption
+			self.memory.move_to_end(key)
+			while len(self.memory) > self.entries:
+				self.memory.popitem(last=False)
+
+	def put(self, key, caption):
+		self.remember(key, caption)
+		bitmap, x, bottom = caption
+		if bitmap.size == 0:
+			return
+		info = PngInfo()
+		info.add_text("x", str(x))
+		info.add_text("bottom", str(bottom))
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		temp_path = "%s.%d.tmp" % (path, os.getpid())
+		Image.fromarray(bitmap).save(temp_path, format="PNG", pnginfo=info)
+		os.replace(temp_path, path)
+
+	def info(self, key):
+		# (bitmap width, bitmap height, x, bottom) without decoding the pixels
+		with self.lock:
+			if key in self.memory:
+				bitmap, x, bottom = self.memory[key]
+				return bitmap.shape[1], bitmap.shape[0], x, bottom
+		try:
+			with Image.open(self.path(key)) as image:
+				return image.width, image.height, int(image.info["x"]), int(image.info["bottom"])
+		except (OSError, KeyError, ValueError):
+			return None
+
+	def contains(self, key):
+		return key in self.memory or os.path.exists(self.path(key))
+
+	def evict(self, keep=()):
+		found = []
+		for root, _, files in os.walk(self.directory):
+			for name in files:
+				if name.endswith(".png"):
+					path = os.path.join(root, name)
+					try:
+						st = os.stat(path)
+					except OSError:
+						continue
+					found.append((st.st_mtime, path, st.st_size))
+		total = sum(size for _, _, size in found)
+		for _, path, size in sorted(found):
+			if total <= self.max_bytes:
+				break
+			if path not in keep:
+				try:
+					os.unlink(path)
+				except OSError:
+					pass
+				total -= size
+
+_default_cache = None
+
+def default_cache():
+	global _default_cache
+	if _default_cache is None:
+		_default_cache = CaptionCache()
+	return _default_cache
+
+def render_caption(text, width, font_path=TTF_FONTFILE, size=FONT_SIZE, cache=None):
+	# Cached (bitmap, x, distance from the bottom of the frame to the top of the bitmap)
+	cache = cache or default_cache()
+	key = cache.key(text, font_path, size, width)
+	caption = cache.get(key)
+	if caption is None:
+		caption = draw_caption(text, width, load_font(font_path, size))
+		cache.put(key, caption)
+	return caption
+
+def caption_info(text, width, font_path=TTF_FONTFILE, size=FONT_SIZE, cache=None):
+	# Size and placement of a caption, rendering it only if it is not cached yet
+	cache = cache or default_cache()
+	info = cache.info(cache.key(text, font_path, size, width))
+	if info is None:
+		bitmap, x, bottom = render_caption(text, width, font_path, size, cache)
+		info = (bitmap.shape[1], bitmap.shape[0], x, bottom)
+	return info
+
+class CaptionSource:
+	# Hands out caption pixels while a caption is on screen: a bitmap is loaded on its first frame and
+	# released once the timeline has moved past its end, so only the visible captions are held in memory
+	def __init__(self, width, font_path=TTF_FONTFILE, size=FONT_SIZE):
+		self.width = width
+		self.font_path = font_path
+		self.size = size
+		self.captions = []  # (text, start, end) in seconds
+		self.loaded = {}  # index -> (RGB pixels, alpha as float mask)
+
+	def add(self, text, start, end):
+		self.captions.append((text, start, end))
+		return len(self.captions) - 1
+
+	def load(self, index, t):
+		now = self.captions[index][1] + t
+		for i in [i for i in self.loaded if self.captions[i][2] <= now and i != index]:
+			del self.loaded[i]
+		if index not in self.loaded:
+			bitmap, _, _ = render_caption(self.captions[index][0], self.width, self.font_path, self.size)
+			self.loaded[index] = (bitmap[:, :, :3], bitmap[:, :, 3] / 255.0)
+		return self.loaded[index]
+
+	def frame(self, index, t):
+		return self.load(index, t)[0]
+
+	def mask(self, index, t):
+		return self.load(index, t)[1]
+
+def blend_caption(frame, caption):
+	# Alpha-blend a cached caption onto an RGB frame in place
+	bitmap, x, bottom = caption
+	if bitmap.size == 0:
+		return frame
+	height = frame.shape[0]
+	y = height - bottom
+	top = max(0, -y)
+	rows = min(bitmap.shape[0], height - y)
+	cols = min(bitmap.shape[1], frame.shape[1] - x)
+	if rows <= top or cols <= 0:
+		return frame
+	region = frame[y + top:y + rows, x:x + cols, :3]
+	pixels = bitmap[top:rows, :cols]
+	alpha = pixels[:, :, 3:4].astype(np.uint16)
+	region[:] = ((region * (255 - alpha) + pixels[:, :, :3] * alpha + 127) // 255).astype(np.uint8)
+	return frame
+
+class CaptionTrack:
+	# Captions placed on the output timeline, composited directly onto frames
+	def __init__(self, captions, width, font_path=TTF_FONTFILE, size=FONT_SIZE):
+		self.captions = sorted(captions, key=lambda c: c[1])  # (text, start sec, duration sec)
+		self.starts = [start for _, start, _ in self.captions]
+		self.width = width
+		self.font_path = font_path
+		self.size = size
+
+	def active(self, t):
+		# Captions end before the next one starts, so only the last few that started can still be showing
+		i = bisect_right(self.starts, t)
+		return [text for text, start, duration in self.captions[max(0, i - 4):i] if t < start + duration]
+
+	def composite(self, frame, t):
+		for text in self.active(t):
+			if not frame.flags.writeable:
+				frame = frame.copy()
+			blend_caption(frame, render_caption(text, self.width, self.font_path, self.size))
+		return frame
+
+def paste_caption(caption, width, height):
+	# Full-frame RGBA image with the caption at its place
+	bitmap, x, bottom = caption
+	image = np.zeros((height, width, 4), dtype=np.uint8)
+	if bitmap.size == 0:
+		return image
+	y = height - bottom
+	top = max(0, -y)
+	rows = min(bitmap.shape[0], height - y)
+	image[y + top:y + rows, x:x + bitmap.shape[1]] = bitmap[top:rows]
+	return image
+
+def _prerender(args):
+	text, width, font_path, size = args
+	render_caption(text, width, font_path, size)
+
+def prerender_captions(texts, width, font_path=TTF_FONTFILE, size=FONT_SIZE, processes=None):
+	# Render every caption missing from the disk cache in a pool of processes before compositing starts
+	cache = default_cache()
+	missing = []
+	paths = set()
+	for text in dict.fromkeys(texts):
+		key = cache.key(text, font_path, size, width)
+		paths.add(cache.path(key))
+		if not cache.contains(key):
+			missing.append((text, width, font_path, size))
+	if len(missing) > 1 and processes != 1:
+		with ProcessPoolExecutor(max_workers=processes) as executor:
+			list(executor.map(_prerender, missing, chunksize=max(1, len(missing) // (4 * (processes or os.cpu_count() or 1)))))
+	else:
+		for args in missing:
+			_prerender(args)
+	# Once per export: the captions it is about to use are kept
+	cache.evict(keep=paths)
+	return len(missing)
@@ -1,54 +1,492 @@
 import sys
-from PySide2.QtCore import Qt, QUrl, QTimer, Signal, QIODevice, QByteArray, QPoint
-from PySide2.QtGui import QTextCursor, QCloseEvent, QPixmap, QKeyEvent,  QInputMethodEvent, QColor, QBrush
-from PySide2.QtMultimedia import QMediaContent, QMediaPlayer, QAbstractVideoBuffer
+from PySide2.QtCore import (Qt, QUrl, QTimer, Signal, QIODevice, QByteArray, QPoint, QAbstractTableModel, QModelIndex, QPersistentModelIndex, QEvent,
+							QObject, QRunnable, QThreadPool)
+from PySide2.QtGui import QTextCursor, QCloseEvent, QKeyEvent,  QInputMethodEvent, QColor, QBrush
+from PySide2.QtMultimedia import QMediaContent, QMediaPlayer, QAbstractVideoBuffer, QAudio, QAudioFormat, QAudioOutput
 from PySide2.QtMultimediaWidgets import QVideoWidget, QGraphicsVideoItem
 from PySide2.QtWidgets import (QApplication, QSlider, QVBoxLayout, QWidget,
 							   QTextEdit, QTableWidget, QTableWidgetItem, QHBoxLayout, QLabel, QPushButton,
-							   QToolButton, QAbstractItemView, QLineEdit, QTabWidget, QStyledItemDelegate)
+							   QToolButton, QAbstractItemView, QLineEdit, QTabWidget, QStyledItemDelegate, QTableView)
 from PySide2.QtWidgets import QSizePolicy
-from PySide2.QtGui import QPainter, QPen, QPixmap
+from PySide2.QtGui import QPainter, QPen, QPainterPath, QTransform, QImage
 from PySide2.QtWidgets import QGraphicsView, QGraphicsScene
 
-import requests, threading, json, tempfile, MeCab, unidic, pandas as pd, alkana, re, os, tqdm, qtawesome as qta, io, wave
-from pydub import AudioSegment
+import threading, qtawesome as qta, math, time, itertools, queue
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from concurrent.futures import Future, CancelledError
+from array import array
+from voicevox import VOICEVOX_SERVER, synthesize_stream, parse_wav_header, new_session
+from trajectory_store import TrajectoryStore
+from journal import Journal, COMPACT_BYTES, load_document, remove_clear_event
+from metrics import log
+from timeline import CommentTimeline, compile_comment, load_plan, default_cache as default_plan_cache
+
+# How far ahead (in wall-clock milliseconds) speech is synthesized before its comment is due
+SPEECH_PREFETCH_WINDOW = 10000
+# Synthesis requests the player runs at the same time
+SPEECH_WORKERS = 2
+# A comment is shown once it is at most this many milliseconds (media time) ahead of the position
+COMMENT_TOLERANCE = 5
+# Size of the stroke group thumbnails in the trajectory table
+THUMBNAIL_SIZE = (80, 60)
+# Edits are appended to the journal this often (milliseconds)
+AUTOSAVE_INTERVAL = 2000
+
+class SpeechQueue:
+	# A fixed number of synthesis workers taking requests in order of their due time (media ms). Requests carry the seek
+	# generation they were made in: after a seek, queued ones are dropped before they reach VOICEVOX and running ones stop.
+	def __init__(self, workers=SPEECH_WORKERS, server=VOICEVOX_SERVER):
+		self.server = server
+		self.queue = queue.PriorityQueue()
+		self.sequence = itertools.count()  # keeps requests due at the same time in submission order
+		self.generation = 0
+		self.synthesized = 0
+		self.dropped = 0
+		self.threads = [threading.Thread(target=self.work, name="speech-%d" % i, daemon=True) for i in range(workers)]
+		for thread in self.threads:
+			thread.start()
+
+	def submit(self, due, text, speaker=0, speedScale=1.0, sink=None):
+		# Future of the WAV bytes; sink, if given, is called on the worker thread with each chunk as it arrives
+		future = Future()
+		self.queue.put((due, next(self.sequence), self.generation, text, speaker, speedScale, future, sink))
+		return future
+
+	def advance(self):
+		# A seek: everything requested so far is out of date
+		self.generation += 1
+
+	def work(self):
+		# MeCab and its dictionary load here, off the UI thread, while the window comes up
+		from textnorm import alpha_to_kana
+		alpha_to_kana("")
+		session = new_session()
+		while True:
+			_, _, generation, text, speaker, speedScale, future, sink = self.queue.get()
+			if future is None:
+				break
+			if generation != self.generation:
+				future.cancel()
+			if not future.set_running_or_notify_cancel():
+				self.dropped += 1
+				continue
+			try:
+				chunks = []
+				for chunk in synthesize_stream(alpha_to_kana(text), speaker, speedScale, server=self.server, session=session):
+					if generation != self.generation:
+						raise CancelledError()
+					chunks.append(chunk)
+					if sink is not None:
+						sink(chunk)
+				future.set_result(b"".join(chunks))
+				self.synthesized += 1
+			except CancelledError as e:
+				self.dropped += 1
+				future.set_exception(e)
+			except Exception as e:
+				future.set_exception(e)
+
+	def shutdown(self):
+		self.advance()
+		for _ in self.threads:
+			self.queue.put((math.inf, next(self.sequence), None, None, None, None, None, None))
+
+class SpeechPrefetcher:
+	# Synthesizes speech for upcoming comments in the background so that it is ready when the comment is due
+	def __init__(self, player, window=SPEECH_PREFETCH_WINDOW, limit=32):
+		self.player = player
+		self.window = window
+		self.limit = limit
+		self.lock = threading.Lock()
+		self.pending = {}  # (offset, speech text) -> Future of WAV bytes
+		self.nextUpdate = None  # media position at which the next comment enters the window
+
+	def update(self, position):
+		player = self.player
+		rate = player.playbackRate * player.playbackScale
+		horizon = position + self.window * rate  # media time reached within the window
+		self.nextUpdate = None
+		with self.lock:
+			# Drop audio for comments that have already been passed
+			for key in [key for key in self.pending if key[0] < position - 1000]:
+				self.pending.pop(key).cancel()
+			for i in range(player.nextCommentIndex, len(player.comments)):
+				if len(self.pending) >= self.limit:
+					break
+				entry = player.timeline.entries[i]
+				if entry.offset > horizon:
+					self.nextUpdate = entry.offset - self.window * rate
+					break
+				if entry.text == "[":
+					continue
+				key = (entry.offset, entry.speech)
+				if key not in self.pending:
+					self.pending[key] = player.speechQueue.submit(entry.offset, entry.speech, 0, player.audioSpeedScale)
+
+	def take(self, offset, speech_text):
+		with self.lock:
+			return self.pending.pop((offset, speech_text), None)
+
+	def invalidate(self):
+		with self.lock:
+			for future in self.pending.values():
+				future.cancel()
+			self.pending.clear()
+		self.nextUpdate = 0  # Refill on the next wake-up
+
+class VoiceOutput(QObject):
+	# Plays synthesized speech from memory through QAudioOutput. The WAV bytes of an utterance may arrive in chunks
+	# from a worker thread; playback starts as soon as the header and the first samples are in.
+	chunkReady = Signal(int, object)
+	finished = Signal(int)
+
+	def __init__(self, parent=None):
+		super(VoiceOutput, self).__init__(parent)
+		self.output = None
+		self.device = None
+		self.format = None  # (channels, sample rate, bytes per sample) of the audio output
+		self.utterance = 0  # chunks of older utterances are dropped
+		self.header = bytearray()  # bytes received before the samples start
+		self.pending = bytearray()  # samples not yet taken by the audio device
+		self.started = True
+		self.complete = True
+		self.requested = None  # perf_counter() when the utterance was requested
+		self.latencies = deque(maxlen=10000)  # milliseconds from the request to the first samples handed to the device
+		self.drainTimer = QTimer(self)
+		self.drainTimer.setInterval(10)
+		self.drainTimer.timeout.connect(self.drain)
+		self.chunkReady.connect(self.feed)
+		self.finished.connect(self.finish)
+
+	def begin(self):
+		# Start a new utterance, cutting off the one being played; returns its id for the chunks
+		self.stop()
+		self.started = False
+		self.complete = False
+		self.requested = time.perf_counter()
+		return self.utterance
+
+	def play(self, wav_data):
+		utterance = self.begin()
+		self.feed(utterance, wav_data)
+		self.finish(utterance)
+
+	def feed(self, utterance, data):
+		if utterance != self.utterance:
+			return
+		if self.started:
+			self.pending += data
+		else:
+			self.header += data
+			header = parse_wav_header(self.header)
+			if header is None:
+				return
+			self.open(header[:3])
+			self.pending += self.header[header[3]:]
+			self.header = bytearray()
+			self.started = True
+		self.drain()
+
+	def finish(self, utterance):
+		if utterance != self.utterance:
+			return
+		self.complete = True
+		self.drain()
+
+	def open(self, params):
+		if self.output is None or self.format != params:
+			channels, rate, width = params
+			audioFormat = QAudioFormat()
+			audioFormat.setSampleRate(rate)
+			audioFormat.setChannelCount(channels)
+			audioFormat.setSampleSize(width * 8)
+			audioFormat.setCodec("audio/pcm")
+			audioFormat.setByteOrder(QAudioFormat.LittleEndian)
+			audioFormat.setSampleType(QAudioFormat.UnSignedInt if width == 1 else QAudioFormat.SignedInt)
+			if self.output is not None:
+				self.output.stop()
+				self.output.deleteLater()
+			self.output = QAudioOutput(audioFormat, self)
+			self.output.stateChanged.connect(self.stateChanged)
+			self.format = params
+		self.device = self.output.start()
+
+	def drain(self):
+		# Push as much as the device takes; the rest waits for the next tick
+		if self.device is None:
+			return
+		while self.pending:
+			free = self.output.bytesFree()
+			if free <= 0:
+				break
+			written = self.device.write(bytes(self.pending[:free]))
+			if written <= 0:
+				break
+			del self.pending[:written]
+			if self.requested is not None:
+				self.latencies.append((time.perf_counter() - self.requested) * 1000)
+				self.requested = None
+		if self.pending:
+			self.drainTimer.start()
+		else:
+			self.drainTimer.stop()
+
+	def stateChanged(self, state):
+		# Idle means the device ran out of samples: the end of the utterance, or a chunk that is late
+		if state == QAudio.IdleState and self.complete and not self.pending:
+			self.output.stop()
+			self.device = None
+
+	def stop(self):
+		self.utterance += 1
+		self.header = bytearray()
+		self.pending = bytearray()
+		self.requested = None
+		self.drainTimer.stop()
+		if self.output is not None:
+			self.output.stop()
+		self.device = None
+
+	def stats(self):
+		latency = sorted(self.latencies)
+		if not latency:
+			return {"utterances": 0, "mean": 0, "p95": 0, "max": 0}
+		return {"utterances": len(latency), "mean": sum(latency) / len(latency), "p95": latency[int(0.95 * (len(latency) - 1))], "max": latency[-1]}
+
+class PlaybackScheduler:
+	# Wakes the player up when something on screen changes next: a comment, a trajectory point, a clear event,
+	# the next second of the position label or a comment entering the prefetch window. Media time is converted
+	# to wall-clock time with the effective playback rate, and nothing runs while playback is paused.
+	def __init__(self, player):
+		self.player = player
+		self.timer = QTimer()
+		self.timer.setSingleShot(True)
+		self.timer.setTimerType(Qt.PreciseTimer)
+		self.timer.timeout.connect(self.fire)
+		self.lateness = deque(maxlen=10000)  # wall-clock milliseconds between a comment's time and its display
+
+	def nextEvent(self, position):
+		player = self.player
+		events = [(position // 1000 + 1) * 1000]  # Position label
+		if player.nextCommentIndex < len(player.timeline):
+			events.append(player.timeline.offsets[player.nextCommentIndex])
+		next_point = player.trajectoryOverlay.nextTime(position)
+		if next_point is not None:
+			events.append(next_point)
+		i = bisect_right(player.clear_events, position)
+		if i < len(player.clear_events):
+			events.append(player.clear_events[i])
+		if player.prefetcher.nextUpdate is not None:
+			events.append(player.prefetcher.nextUpdate)
+		return min(events)
+
+	def reschedule(self):
+		# Re-arm the timer for the next event; called on every seek, rate, state or timeline change
+		self.timer.stop()
+		mediaPlayer = self.player.mediaPlayer
+		if mediaPlayer.state() != QMediaPlayer.PlayingState:
+			return
+		position = mediaPlayer.position()
+		rate = mediaPlayer.playbackRate() or 1.0
+		self.timer.start(max(0, math.ceil((self.nextEvent(position) - position) / rate)))
+
+	def fire(self):
+		self.player.updatePlayback()
+		self.reschedule()
+
+	def record(self, offset, position):
+		self.lateness.append((position - offset) / (self.player.mediaPlayer.playbackRate() or 1.0))
+
+	def stats(self):
+		jitter = sorted(abs(late) for late in self.lateness)
+		if not jitter:
+			return {"comments": 0, "mean": 0, "p95": 0, "max": 0}
+		return {"comments": len(jitter), "mean": sum(jitter) / len(jitter), "p95": jitter[int(0.95 * (len(jitter) - 1))], "max": jitter[-1]}
+
+class TrajectoryOverlay:
+	# Keeps one persistent path item per stroke and only touches the items whose visible part changed
+	def __init__(self, scene, pen):
+		self.scene = scene
+		self.pen = pen
+		self.transform = QTransform()
+		self.strokes = {}  # start press time -> stroke state
+		self.times = []  # times of all points, sorted
+
+	def clear(self):
+		for stroke in self.strokes.values():
+			self.scene.removeItem(stroke["item"])
+		self.strokes = {}
+		self.times = []
+
+	def rebuild(self, trajectory):
+		self.clear()
+		for start_press_time, curr_time, x, y in trajectory:
+			self.addPoint(start_press_time, curr_time, x, y)
+
+	def addPoint(self, start_press_time, curr_time, x, y):
+		if start_press_time is None:
+			return
+		stroke = self.strokes.get(start_press_time)
+		if stroke is None:
+			item = self.scene.addPath(QPainterPath(), self.pen)
+			item.setTransform(self.transform)
+			item.setZValue(1)  # Above the video item
+			item.setVisible(False)
+			stroke = self.strokes[start_press_time] = {"times": [], "points": [], "item": item, "range": None}
+		stroke["times"].append(curr_time)
+		stroke["points"].append((x, y))
+		stroke["range"] = None  # Force the path to be rebuilt on the next update
+		if self.times and curr_time < self.times[-1]:
+			insort(self.times, curr_time)
+		else:
+			self.times.append(curr_time)
+
+	def nextTime(self, position):
+		# Time of the first point drawn after the position, or None
+		i = bisect_right(self.times, position)
+		return self.times[i] if i < len(self.times) else None
+
+	def setTransform(self, transform):
+		self.transform = transform
+		for stroke in self.strokes.values():
+			stroke["item"].setTransform(transform)
+
+	def update(self, position, clear_events):
+		# A segment is shown once its end point is reached, until the next clear event
+		i = bisect_left(clear_events, position)
+		last_clear = clear_events[i - 1] if i > 0 else None
+		for stroke in self.strokes.values():
+			times = stroke["times"]
+			first = max(1, bisect_right(times, last_clear)) if last_clear is not None else 1
+			last = bisect_right(times, position)
+			visible = (first, last) if last > first else (0, 0)
+			if visible == stroke["range"]:
+				continue
+			stroke["range"] = visible
+			if visible == (0, 0):
+				stroke["item"].setVisible(False)
+				continue
+			points = stroke["points"]
+			path = QPainterPath()
+			path.moveTo(*points[first - 1])
+			for x, y in points[first:last]:
+				path.lineTo(x, y)
+			stroke["item"].setPath(path)
+			stroke["item"].setVisible(True)
+
+class ThumbnailSignals(QObject):
+	# key, QImage, start time of the first stroke in the group (None if the group is empty)
+	finished = Signal(object, object, object)
+
+class ThumbnailJob(QRunnable):
+	# Renders the strokes drawn between two clear events into a QImage on a worker thread
+	def __init__(self, key, lower, columns):
+		super(ThumbnailJob, self).__init__()
+		self.key = key
+		self.lower = lower
+		self.columns = columns  # copies of the (start time, time, x, y) columns of the trajectory
+		self.signals = ThumbnailSignals()
+
+	def run(self):
+		clear_time = self.key[0]
+		width, height = THUMBNAIL_SIZE
+		image = QImage(width, height, QImage.Format_RGB32)
+		image.fill(Qt.white)  # Fill the thumbnail with a white background
+		painter = QPainter(image)
+		painter.setPen(QColor(Qt.red))  # Set the pen color to red
+		start_time = None
+		previous = None
+		for start, t, x, y in zip(*self.columns):
+			if not (self.lower <= t < clear_time):
+				previous = None
+				continue
+			if start_time is None:
+				start_time = start
+			if previous is not None and previous[0] == start:
+				painter.drawLine((previous[1] + 1) / 2 * width, (previous[2] + 1) / 2 * height, (x + 1) / 2 * width, (y + 1) / 2 * height)
+			previous = (start, x, y)
+		painter.end()
+		self.signals.finished.emit(self.key, image, start_time)
 
-# Global variable for the hostname of the VOICEVOX server
-VOICEVOX_SERVER = "http://localhost:50021"
+class ThumbnailDelegate(QStyledItemDelegate):
+	def paint(self, painter, option, index):
+		if index.column() == 1:
+			thumbnail = index.data(Qt.DecorationRole)
+			if thumbnail:
+				painter.drawImage(option.rect.x(), option.rect.y(), thumbnail)
+		else:
+			super().paint(painter, option, index)
 
-# Helper function: Convert alphabet to Katakana
-# https://qiita.com/kunishou/items/814e837cf504ce287a13
-def alpha_to_kana(text):
-	# Check if string is alphabetic
-	alphaReg = re.compile(r'^[a-zA-Z]+$')
-	def isalpha(s):
-		return alphaReg.match(s) is not None
+class CommentsModel(QAbstractTableModel):
+	# Comments table over the player's comment list: rows are read from player.comments when they are painted,
+	# so no widget is created per comment
+	HEADERS = ["...", "Time", "Comment"]
 
-	sample_txt = text
+	def __init__(self, player):
+		super(CommentsModel, self).__init__()
+		self.player = player
 
-	wakati = MeCab.Tagger('-Owakati')
-	wakati_result = wakati.parse(sample_txt)
+	def rowCount(self, parent=QModelIndex()):
+		return 0 if parent.isValid() else len(self.player.comments)
 
-	df = pd.DataFrame(wakati_result.split(" "),columns=["word"])
-	df = df[df["word"].str.isalpha() == True]
-	df["english_word"] = df["word"].apply(isalpha)
-	df = df[df["english_word"] == True]
-	df["katakana"] = df["word"].apply(alkana.get_kana)
+	def columnCount(self, parent=QModelIndex()):
+		return 0 if parent.isValid() else len(self.HEADERS)
 
-	dict_rep = dict(zip(df["word"], df["katakana"]))
+	def headerData(self, section, orientation, role=Qt.DisplayRole):
+		if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+			return self.HEADERS[section]
+		return None
 
-	for word, read in dict_rep.items():
-		sample_txt = sample_txt.replace(word, read or "")
-	return sample_txt
+	def data(self, index, role=Qt.DisplayRole):
+		if not index.isValid() or role not in (Qt.DisplayRole, Qt.EditRole, Qt.ToolTipRole):
+			return None
+		offset, comment = self.player.comments[index.row()]
+		if index.column() == 1:
+			return self.player.formatTime(offset)
+		elif index.column() == 2:
+			return comment
+		return None
 
-class ThumbnailDelegate(QStyledItemDelegate):
-	def paint(self, painter, option, index):
+	def flags(self, index):
+		flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
 		if index.column() == 1:
-			thumbnail = index.data(Qt.DecorationRole)
-			if thumbnail:
-				painter.drawPixmap(option.rect.x(), option.rect.y(), thumbnail)
-		else:
-			super().paint(painter, option, index)
+			flags |= Qt.ItemIsEditable
+		return flags
+
+	def setData(self, index, value, role=Qt.EditRole):
+		if role != Qt.EditRole or index.column() != 1:
+			return False
+		oldOffset, _ = self.player.comments[index.row()]
+		if value == self.player.formatTime(oldOffset):
+			return False  # Edited without a change
+		newOffset = self.player.timeToMs(value)
+		# Move the comment to its place once the editor has closed
+		row = QPersistentModelIndex(index)
+		QTimer.singleShot(0, lambda: self.player.moveComment(row.row(), newOffset) if row.isValid() else None)
+		return True
+
+	def rowChanged(self, row):
+		self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.HEADERS) - 1))
+
+class CommentDeleteDelegate(QStyledItemDelegate):
+	# Paints the trash icon of the first column and reports clicks on it
+	removeClicked = Signal(int)
+
+	def __init__(self, parent=None):
+		super(CommentDeleteDelegate, self).__init__(parent)
+		self.icon = qta.icon('fa5s.trash-alt')
+
+	def paint(self, painter, option, index):
+		super().paint(painter, option, index)
+		size = min(16, option.rect.width(), option.rect.height())
+		self.icon.paint(painter, option.rect.x() + (option.rect.width() - size) // 2, option.rect.y() + (option.rect.height() - size) // 2, size, size)
+
+	def editorEvent(self, event, model, option, index):
+		if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton and option.rect.contains(event.pos()):
+			self.removeClicked.emit(index.row())
+			return True
+		return super().editorEvent(event, model, option, index)
 
 class IMETextEdit(QTextEdit):
 	editingStarted = Signal()
@@ -64,22 +502,24 @@ class IMETextEdit(QTextEdit):
 		super().keyPressEvent(event)
 
 class VideoPlayer(QWidget):
-	def __init__(self, filename, parent=None, playbackRate = 1.0, audioSpeedScale = 1.0):
+	def __init__(self, filename, parent=None, playbackRate = 1.0, audioSpeedScale = 1.0, prefetchWindow = SPEECH_PREFETCH_WINDOW):
 		super(VideoPlayer, self).__init__(parent)
 
 		self.filename = filename
 		self.playbackRate = playbackRate
 		self.playbackScale = 1.0
-		self.trajectory = []  # To store the trajectory [(time, x, y), ...]
+		self.trajectory = TrajectoryStore()  # To store the trajectory [(start time, time, x, y), ...]
 		self.clear_events = []  # To store the times of right-click clear events
 
 		self.mediaPlayer = QMediaPlayer(None, QMediaPlayer.VideoSurface)
-		self.voicePlayer = QMediaPlayer()
+		self.voiceOutput = VoiceOutput(self)
 
 		# Create a QGraphicsView for drawing the trajectory
 		self.graphicsScene = QGraphicsScene()
 		self.graphicsView = QGraphicsView(self.graphicsScene)
-		self.drawnItems = []
+		pen = QPen(Qt.red, 3)  # Set pen color and thickness
+		pen.setCosmetic(True)  # Keep the thickness while the strokes are scaled to the video
+		self.trajectoryOverlay = TrajectoryOverlay(self.graphicsScene, pen)
 		self.graphicsView.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
 		self.graphicsView.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
 
@@ -88,7 +528,7 @@ class VideoPlayer(QWidget):
 		self.slider = QSlider(Qt.Horizontal)
 		self.playButton  = QToolButton()
 		self.commentEdit = IMETextEdit()
-		self.commentsTable = QTableWidget(0, 3)
+		self.commentsTable = QTableView()
 		self.tabWidget = QTabWidget()
 
 		# Trajectory Table
@@ -97,6 +537,12 @@ class VideoPlayer(QWidget):
 		self.trajectoryTable.setHorizontalHeaderLabels(['Offset Time', 'Thumbnail', 'Remove'])
 		self.trajectoryTable.setItemDelegate(ThumbnailDelegate())
 		self.trajectoryTable.clicked.connect(self.selectTrajectory)  # CHANGE HERE
+		# Thumbnails are rendered one at a time in the background and kept per group of strokes
+		self.thumbnailPool = QThreadPool()
+		self.thumbnailPool.setMaxThreadCount(1)
+		self.thumbnails = {}  # (clear time, number of points) -> (QImage, start time)
+		self.thumbnailJobs = {}  # key -> ThumbnailJob being rendered
+		self.trajectoryGroupCounts = [0]  # points between consecutive clear events, the last entry after the last one
 
 		# Add tabs
 		self.tabWidget.addTab(self.commentsTable, "Comments")
@@ -149,7 +595,8 @@ class VideoPlayer(QWidget):
 		layout.addLayout(commentLayout)
 		self.setLayout(layout)
 
-		self.comments = []  # To store the comments
+		self.comments = []  # To store the comments, sorted by offset
+		self.timeline = CommentTimeline()  # Offsets, speed changes and skip zones of self.comments for bisect lookups
 		self.currentPosition = None
 
 		self.mediaPlayer.setVideoOutput(self.videoWidget)
@@ -161,84 +608,108 @@ class VideoPlayer(QWidget):
 		self.commentEdit.editingStarted.connect(self.startEditing)
 		self.editPositionLabel.mousePressEvent = self.showOffsetInput  # CHANGE HERE
 		self.playButton.clicked.connect(self.changeMediaState)
-		self.commentsTable.itemChanged.connect(self.tableItemChanged)
 
 		self.saveButton.clicked.connect(self.saveComments)
 		self.loadButton.clicked.connect(self.loadComments)
 
 		self.playButton.setIcon(qta.icon('fa5s.play'))
 
-		self.commentsTable.setHorizontalHeaderLabels(["...", "Time", "Comment"])
+		self.commentsModel = CommentsModel(self)
+		self.commentsTable.setModel(self.commentsModel)
+		self.commentDeleteDelegate = CommentDeleteDelegate(self.commentsTable)
+		# Queued, so that the row is removed once the view has finished with the click
+		self.commentDeleteDelegate.removeClicked.connect(self.deleteComment, Qt.QueuedConnection)
+		self.commentsTable.setItemDelegateForColumn(0, self.commentDeleteDelegate)
 		self.commentsTable.horizontalHeader().setStretchLastSection(True)
+		self.commentsTable.verticalHeader().setDefaultSectionSize(32)
 		self.commentsTable.setSelectionBehavior(QAbstractItemView.SelectRows)
 		self.commentsTable.setColumnWidth(0, 32)  # set the width of the first column to 50
 		self.commentsTable.clicked.connect(self.selectComment)  # CHANGE HERE
 
+		# One timer for the position label, the comment overlay and the trajectory, armed for the next event only
+		self.scheduler = PlaybackScheduler(self)
+		self.nextCommentIndex = 0
+		self.speechQueue = SpeechQueue()
+		self.speechFuture = None  # request for the comment being spoken
+		self.prefetcher = SpeechPrefetcher(self, prefetchWindow)
+
 		self.mediaPlayer.setMedia(QMediaContent(QUrl.fromLocalFile(filename)))
 		self.setPlaybackRate(playbackRate)
-		self.audioSpeedScale = audioSpeedRate
-
-		# Timer for updating the current position label
-		self.timer = QTimer()
-		self.timer.setInterval(1000 / playbackRate)
-		self.timer.timeout.connect(self.updatePositionLabel)
-		self.timer.start()
-
-		# Timer for updating comment overlay every second
-		self.overlayTimer = QTimer()
-		self.overlayTimer.setInterval(1000  / playbackRate)
-		self.overlayTimer.timeout.connect(self.updateOverlay)
-		self.overlayTimer.start()
-
-		self.nextCommentIndex = 0
+		self.audioSpeedScale = audioSpeedScale
 
 		# Set up the loading icon
 		self.loadingIcon = qta.icon('fa.spinner', color='red', animation=qta.Spin(self.commentEdit))
 
-		# Timer to update the trajectory overlay
-		self.trajectoryTimer = QTimer(self)
-		self.trajectoryTimer.setInterval(50)  # Update at approximately 60 FPS
-		self.trajectoryTimer.timeout.connect(self.updateTrajectoryOverlay)
-		self.trajectoryTimer.start()
-
 		# Enable mouse tracking
 		self.graphicsView.setMouseTracking(True)
 		self.graphicsView.mousePressEvent = self.mousePressEvent
 		self.graphicsView.mouseMoveEvent = self.mouseMoveEvent
 		self.graphicsView.mouseReleaseEvent = self.mouseReleaseEvent
+		self.videoWidget.nativeSizeChanged.connect(self.updateTrajectoryTransform)
+
+		# Edits go to an append-only journal next to the comments, folded into the snapshot once it grows
+		self.journal = None
+		self.autosaveTimer = QTimer(self)
+		self.autosaveTimer.timeout.connect(self.autosave)
+		self.autosaveTimer.start(AUTOSAVE_INTERVAL)
 
 		self.loadComments()
-		self.updateTimer()  # Initialize the timer for the first comment
 		self.setPlaybackRate(playbackRate)
 		self.updateTrajectoryTable()
 
 	def resizeEvent(self, event):
 		self.videoWidget.setSize(self.graphicsView.size())
 		self.graphicsView.fitInView(self.videoWidget, Qt.KeepAspectRatio)
-
-	def tableItemChanged(self, item):
-		# item is the QTableWidgetItem that was changed
-		# We only care about the offset column, which is column 1
-		if item.column() == 1:
-			row = item.row()
-			# Convert the text from the QTableWidgetItem to milliseconds
-			newOffset = self.timeToMs(item.text())
-			# Update self.comments
-			oldOffset, comment = self.comments[row]
-			self.comments[row] = (newOffset, comment)
+		self.updateTrajectoryTransform()
+
+	def videoGeometry(self):
+		# Origin and scale that map normalized trajectory coordinates onto the video item
+		native = self.videoWidget.nativeSize()
+		if native.width() <= 0 or native.height() <= 0:
+			return None
+		offset = QPoint(self.videoWidget.offset().x() + self.videoWidget.size().width() / 2, self.videoWidget.offset().y() + self.videoWidget.size().height() / 2)
+		size_w = self.videoWidget.size().width() / native.width()
+		size_h = self.videoWidget.size().height() / native.height()
+		scale = self.videoWidget.size().height() if size_w > size_h else self.videoWidget.size().width()
+		return offset, scale
+
+	def updateTrajectoryTransform(self):
+		geometry = self.videoGeometry()
+		if geometry is not None:
+			offset, scale = geometry
+			self.trajectoryOverlay.setTransform(QTransform(scale, 0, 0, scale, offset.x(), offset.y()))
+
+	def moveComment(self, row, offset):
+		# Change the offset of a comment, keeping self.comments sorted
+		if row < 0 or row >= len(self.comments):
+			return row
+		_, comment = self.comments[row]
+		previous = self.timeline.offsets[row - 1] if row > 0 else None
+		following = self.timeline.offsets[row + 1] if row + 1 < len(self.comments) else None
+		if (previous is None or previous <= offset) and (following is None or offset < following):
+			self.comments[row] = (offset, comment)
+			self.timeline.move(row, offset)
+			self.journal.record("offset", row, offset)
+		else:
+			self.deleteComment(row)
+			row = self.insertComment(offset, comment)
+		self.commentsModel.rowChanged(row)
+		self.prefetcher.invalidate()
+		return row
 
 	def setComment(self, row, offset, comment):
 		if row < len(self.comments):
-			self.comments[row] = (offset, comment)
-			self.commentsTable.item(row, 1).setText(self.formatTime(offset))
-			self.commentsTable.cellWidget(row, 2).children()[1].setText(comment)
+			if offset != self.comments[row][0]:
+				row = self.moveComment(row, offset)
+			self.updateComment(row, comment)
 		else:
 			# Handle the error when the row is out of range.
 			pass
-		self.updateTimer()  # Update the timer based on the new position
+		self.scheduler.reschedule()  # The next comment may have changed
 	
 	def setPlaybackRate(self, rate):
 		self.mediaPlayer.setPlaybackRate(rate)
+		self.scheduler.reschedule()
 
 	def changeMediaState(self):
 		if self.mediaPlayer.state() == QMediaPlayer.PlayingState:
@@ -247,6 +718,17 @@ class VideoPlayer(QWidget):
 			self.mediaPlayer.play()
 
 	def closeEvent(self, event: QCloseEvent) -> None:
+		stats = self.scheduler.stats()
+		if stats["comments"] > 0:
+			log(1, "Comment timing: %(comments)d comments, %(mean).1f ms mean, %(p95).1f ms p95, %(max).1f ms max jitter" % stats)
+		stats = self.voiceOutput.stats()
+		if stats["utterances"] > 0:
+			log(1, "Voice start: %(utterances)d utterances, %(mean).1f ms mean, %(p95).1f ms p95, %(max).1f ms max latency" % stats)
+		if self.speechQueue.synthesized or self.speechQueue.dropped:
+			log(1, "Speech requests: %d synthesized, %d dropped as out of date", self.speechQueue.synthesized, self.speechQueue.dropped)
+		self.speechQueue.shutdown()
+		self.autosaveTimer.stop()
+		self.journal.close()
 		QApplication.quit()
 
 	def mediaStateChanged(self, state):
@@ -254,61 +736,41 @@ class VideoPlayer(QWidget):
 			self.playButton.setIcon(qta.icon("fa5s.pause"))
 		else:
 			self.playButton.setIcon(qta.icon("fa5s.play"))
+		self.scheduler.reschedule()
 
 	def positionChanged(self, position):
+		# Also emitted on seeks, while paused as well: bring the display and the timer in line with the media clock
 		self.slider.setValue(position)
+		self.updatePositionLabel()
+		self.updateTrajectoryOverlay()
+		self.scheduler.reschedule()
 
 	def durationChanged(self, duration):
 		self.slider.setRange(0, duration)
 
-	def findPlaybackSpeedByOffset(self, start_index):
-		for i in range(start_index - 1, -1, -1):
-			offset, comment = self.comments[i]
-			fast_forward_match = re.match(r'^>+(\n)*$', comment)
-			slow_down_match = re.match(r'^<+(\n)*$', comment)
-			if fast_forward_match:
-				multiplier = len(fast_forward_match.group(0).replace('\n', ''))
-				return multiplier
-			elif slow_down_match:
-				divider = len(slow_down_match.group(0).replace('\n', ''))
-				return 1.0 / divider
-		return 1  # Default value if no matching offset is found
-
 	def setPosition(self, position):
-		# Find if the position is in a skipped zone and get the corresponding end offset
-		for i, (offset, comment) in enumerate(self.comments):
-			if comment == "[":
-				end_skip_index = self.findEndSkipIndex(i + 1)
-				if end_skip_index is not None:
-					end_offset = self.comments[end_skip_index][0]
-					if offset <= position < end_offset:
-						# If the position is in a skipped zone, set to the end of that zone
-						position = end_offset
-						break
-		self.voicePlayer.pause()
+		# If the position is in a skipped zone, set to the end of that zone
+		end_offset = self.timeline.skip_end(position)
+		if end_offset is not None:
+			position = end_offset
+		self.voiceOutput.stop()
+		self.speechQueue.advance()
+		self.prefetcher.invalidate()
 		self.mediaPlayer.setPosition(position)
-		for i, (offset, comment) in enumerate(self.comments):
-			if position < offset:
-				self.nextCommentIndex = i
-				break
+		self.nextCommentIndex = self.timeline.next_row(position)
 		# Find the playback speed for the current offset
-		playback_speed = self.findPlaybackSpeedByOffset(self.nextCommentIndex)
+		playback_speed = self.timeline.speed_at(position)
 		self.playbackScale = playback_speed
 		
 		# Update the playback rate if a valid speed was found
 		self.setPlaybackRate(playback_speed * self.playbackRate)
 
-		self.updateTimer()  # Update the timer based on the new position        
-
 	def findEndSkipIndex(self, start_index):
-		for i in range(start_index, len(self.comments)):
-			_, comment = self.comments[i]
-			if comment == "[":
-				# If another "[" is encountered before finding a "]", return None to ignore it
-				return None
-			elif comment == "]":
-				return i
-		return None
+		# Row of the "]" closing the "[" just before start_index, or None if that "[" is not paired
+		end_offset = self.timeline.zone_end(self.comments[start_index - 1][0])
+		if end_offset is None:
+			return None
+		return self.timeline.next_row(end_offset) - 1
 
 	def commentTextChanged(self):
 		comment = self.commentEdit.toPlainText()
@@ -330,19 +792,6 @@ class VideoPlayer(QWidget):
 			self.loadingLabel.setPixmap(self.loadingIcon.pixmap(16, 16))
 			self.editPositionLabel.setText(self.formatTime(self.currentPosition))
 
-	def removeComment(self, row):
-		def _remove():
-			# Get the row from the clicked button
-			row = self.commentsTable.indexAt(btn.pos()).row()
-			del self.comments[row]
-			self.commentsTable.removeRow(row)
-
-		btn = QToolButton()
-		btn.setIcon(qta.icon('fa5s.trash-alt'))  # Set a delete icon using the qtawesome library
-		btn.setSizePolicy(QSizePolicy.Maximum, QSizePolicy.Maximum)
-		btn.clicked.connect(_remove)
-		return btn
-
 	def addComment(self, comment, currentPosition=None):
 		if currentPosition is None:
 			currentPosition = self.currentPosition
@@ -357,63 +806,66 @@ class VideoPlayer(QWidget):
 				self.editPositionLabel.clear()
 				return  # Skip the code for adding a new comment
 
-			new_comment = (currentPosition, comment)
-
-			row = 0
-			while row < len(self.comments):
-				if self.comments[row][0] > currentPosition:
-					break
-				row += 1
-
-			self.comments.insert(row, new_comment)
-
-			self.commentsTable.insertRow(row)
-			self.commentsTable.setItem(row, 1, QTableWidgetItem(self.formatTime(currentPosition)))
-
-			# Create a widget with a layout containing the comment and remove button
-			commentWidget = QWidget()
-			commentLayout = QHBoxLayout()
-			commentLayout.addWidget(QLabel(comment))
-			commentWidget.setLayout(commentLayout)
-
-			self.commentsTable.setCellWidget(row, 2, commentWidget)
-			btn = self.removeComment(row)
-			self.commentsTable.setCellWidget(row, 0, btn)
+			self.insertComment(currentPosition, comment)
 
 			self.currentPosition = None  # Reset the remembered position after adding the comment
 			self.loadingLabel.clear()
 			self.editPositionLabel.clear()
 
+	def insertComment(self, offset, comment, entry=None):
+		row = self.timeline.insert_row(offset)
+		self.commentsModel.beginInsertRows(QModelIndex(), row, row)
+		self.comments.insert(row, (offset, comment))
+		self.timeline.insert(row, entry or compile_comment(offset, comment))
+		self.commentsModel.endInsertRows()
+		self.journal.record("add", row, offset, comment)
+		if row < self.nextCommentIndex:
+			self.nextCommentIndex += 1
+		self.prefetcher.invalidate()
+		self.scheduler.reschedule()
+		return row
+
+	def deleteComment(self, row):
+		if row < 0 or row >= len(self.comments):
+			return
+		self.commentsModel.beginRemoveRows(QModelIndex(), row, row)
+		self.comments.pop(row)
+		self.timeline.remove(row)
+		self.commentsModel.endRemoveRows()
+		self.journal.record("remove", row)
+		if row < self.nextCommentIndex:
+			self.nextCommentIndex -= 1
+		self.prefetcher.invalidate()
+		self.scheduler.reschedule()
+
 	def play(self):
 		self.mediaPlayer.play()
 
 	def updatePositionLabel(self):
 		self.positionLabel.setText(self.formatTime(self.mediaPlayer.position()))
 
+	def updatePlayback(self):
+		# Called by the scheduler whenever one of its events is due
+		self.updatePositionLabel()
+		self.updateOverlay()
+		self.updateTrajectoryOverlay()
+
 	def updateOverlay(self):
 		position = self.mediaPlayer.position()
+		self.prefetcher.update(position)
 		if self.nextCommentIndex < len(self.comments):
-			nextOffset, nextComment = self.comments[self.nextCommentIndex]
+			# The comment was compiled when it was added: special notation is already parsed
+			entry = self.timeline.entries[self.nextCommentIndex]
+			nextOffset, nextComment = entry.offset, entry.text
 			difference = nextOffset - position
 
-			# Parsing the comment text for special notation
-			display_text = re.sub(r'\{([^|]+)\|[^}]+\}', r'\1', nextComment)
-			speech_text = re.sub(r'\{[^|]+\|([^}]+)\}', r'\1', nextComment)
-
-
 			# If the difference is within the threshold, handle the comment
-			if difference <= 50:
-				# Check if the comment matches the pattern for fast forward
-				fast_forward_match = re.match(r'^>+(\n)*$', nextComment)
-				slow_down_match = re.match(r'^<+(\n)*$', nextComment)
-				if fast_forward_match:
-					multiplier = len(fast_forward_match.group(0).replace('\n', ''))
-					self.playbackScale = multiplier
-					self.setPlaybackRate(self.playbackRate * multiplier)
-				elif slow_down_match:
-					divider = len(slow_down_match.group(0).replace('\n', ''))
-					self.playbackScale = 1.0 / divider
-					self.setPlaybackRate(self.playbackRate / divider)
+			if difference <= COMMENT_TOLERANCE:
+				self.scheduler.record(nextOffset, position)
+				# Fast forward (">>") and slow down ("<<") comments
+				if entry.speed is not None:
+					self.playbackScale = entry.speed
+					self.setPlaybackRate(self.playbackRate * entry.speed)
 
 				if nextComment == "[":
 					# Search for the corresponding "]"
@@ -424,30 +876,15 @@ class VideoPlayer(QWidget):
 						self.setPosition(self.comments[end_skip_index][0])
 						return
 
-				self.commentOverlay.setText(display_text)
-				threading.Thread(target=self.play_speech, args=(speech_text, 0)).start()
+				self.commentOverlay.setText(entry.display)
+				self.speak(nextOffset, entry.speech, self.prefetcher.take(nextOffset, entry.speech))
 				self.nextCommentIndex += 1
-				self.updateTimer()
-				
-			# If the difference is within a close range, switch to fine-grained polling
-			elif difference <= 1000:
-				self.overlayTimer.setInterval(50)  # Poll every 50 milliseconds
-			else:
-				self.updateTimer()  # Update the timer interval for the next comment
 		else:
 			self.commentOverlay.clear()
 
-	def updateTimer(self):
-		if self.nextCommentIndex < len(self.comments):
-			position = self.mediaPlayer.position()
-			nextOffset, _ = self.comments[self.nextCommentIndex]
-			# Calculate the difference and set the timer interval
-			difference = max(50, (nextOffset - position) / (self.playbackRate * self.playbackScale) - 50)  # Ensure it's at least 50 milliseconds
-			self.overlayTimer.setInterval(difference)
-		else:
-			self.overlayTimer.setInterval(1000)  # Default to 1-second polling if no more comments
-
 	def selectComment(self, index):  # CHANGE HERE
+		if index.column() == 0:
+			return  # The delete button
 		row = index.row()
 		offset, comment = self.comments[row]
 		self.currentPosition = offset
@@ -456,14 +893,14 @@ class VideoPlayer(QWidget):
 		self.setPosition(offset - 2000)
 
 	def findCommentByPosition(self, position):  # CHANGE HERE
-		for i, (offset, _) in enumerate(self.comments):
-			if offset == position:
-				return i
-		return None
+		return self.timeline.find(position)
 
 	def updateComment(self, row, comment):  # CHANGE HERE
+		self.timeline.replace(row, comment)
 		self.comments[row] = (self.comments[row][0], comment)
-		self.commentsTable.cellWidget(row, 2).children()[1].setText(comment)
+		self.commentsModel.rowChanged(row)
+		self.journal.record("update", row, comment)
+		self.prefetcher.invalidate()
 
 	def showOffsetInput(self, event):  # CHANGE HERE
 		self.editOffset.setText(self.editPositionLabel.text())
@@ -492,54 +929,85 @@ class VideoPlayer(QWidget):
 		self.save(self.filename+".comments.json");
 
 	def save(self, filename):
-		with open(filename, "w", encoding="utf-8") as f:
-			json.dump({"comments": self.comments, "trajectory": self.trajectory, "clear": self.clear_events}, f, ensure_ascii=False, indent=2)
+		# Fold the journal into a new snapshot right away
+		if self.journal is None or self.journal.filename != filename:
+			if self.journal is not None:
+				self.journal.close()
+			self.journal = Journal(filename)
+		self.compact(wait=True)
+		# The comments are compiled already: store the plan so that generate_movie.py does not compile them again
+		plan_cache = default_plan_cache()
+		plan_cache.put(plan_cache.key(self.comments), self.timeline.plan())
 	
+	def autosave(self):
+		if self.journal is None:
+			return
+		self.journal.flush()
+		if self.journal.size > COMPACT_BYTES:
+			self.compact()
+
+	def compact(self, wait=False):
+		# The snapshot is written on the journal's thread from copies of the current state
+		self.journal.compact(list(self.comments), TrajectoryStore(self.trajectory), list(self.clear_events), wait)
+
 	def loadComments(self):
 		self.load(self.filename+".comments.json")
 
 	def load(self, filename):
-		comments = []
+		if self.journal is not None:
+			self.journal.close()  # Writes out what is still pending
+			self.journal = None
 		try:
-			with open(filename, "r") as f:
-				comments = json.load(f)
-				if isinstance(comments, dict):
-					self.trajectory = comments["trajectory"]
-					self.clear_events = comments["clear"]
-					comments = comments["comments"]
-			self.comments = []
-			while self.commentsTable.rowCount() > 0:
-				self.commentsTable.removeRow(0)
-			for offset, comment in comments:
-				self.addComment(comment, offset)
-		except FileNotFoundError as e:
-			pass
-
-	def play_speech(self, text, speaker=0):
-		text = alpha_to_kana(text)
-		res1 = requests.post("http://localhost:50021/audio_query", params={"text": text, "speaker": speaker})
-		data = res1.json()
-		if "speedScale" in data:
-			data["speedScale"] *= audioSpeedRate
-		wav_res = requests.post("http://localhost:50021/synthesis", params={"speaker": speaker}, json=data)
-		wav_data = wav_res.content
+			started = time.perf_counter()
+			# The last snapshot with the edits journaled since replayed on top
+			document = load_document(filename)
+			self.journal = Journal(filename, document["sequence"], document["journal_bytes"])
+			self.trajectory = document["trajectory"]
+			self.clear_events = document["clear"]
+			comments = document["comments"]
+			self.thumbnails.clear()
+			self.countTrajectoryGroups()
+			self.trajectoryOverlay.rebuild(self.trajectory)
+			self.updateTrajectoryOverlay()
+			# Compiled comments come from the plan cache when the file was saved or exported before
+			entries = sorted(load_plan(comments).entries, key=lambda entry: entry.offset)
+			# One model reset for the whole file instead of a row insert per comment
+			self.commentsModel.beginResetModel()
+			self.comments = [(entry.offset, entry.text) for entry in entries]
+			self.timeline.reset(entries)
+			self.nextCommentIndex = self.timeline.next_row(self.mediaPlayer.position())
+			self.commentsModel.endResetModel()
+			self.prefetcher.invalidate()
+			self.scheduler.reschedule()
+			log(1, "Loaded %d comments (%d bytes of journal) in %.1f ms", len(entries), document["journal_bytes"], (time.perf_counter() - started) * 1000)
+		except FileNotFoundError:
+			# A new file starts with an empty journal
+			self.journal = Journal(filename)
+
+	def speak(self, offset, text, prefetched=None):
+		voiceOutput = self.voiceOutput
+		if self.speechFuture is not None:
+			self.speechFuture.cancel()  # The previous comment is still waiting for a worker: it is not spoken any more
+			self.speechFuture = None
+		if prefetched is not None and prefetched.done() and not prefetched.cancelled() and prefetched.exception() is None:
+			voiceOutput.play(prefetched.result())
+			return
+		utterance = voiceOutput.begin()
+		if prefetched is not None and not prefetched.cancel() and not prefetched.done():
+			# Already being synthesized: played as a whole when it is ready
+			future = prefetched
+			future.add_done_callback(lambda future: self.deliverSpeech(utterance, future))
+		else:
+			# Ahead of every prefetch in the queue, and played chunk by chunk as it arrives
+			future = self.speechQueue.submit(offset, text, 0, self.audioSpeedScale, lambda chunk: voiceOutput.chunkReady.emit(utterance, chunk))
+			future.add_done_callback(lambda future: voiceOutput.finished.emit(utterance))
+		self.speechFuture = future
 
-		self.play_voice(wav_data)
-	
-	def play_voice(self, wave_data):
-		# Create a temporary file
-		temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-		temp_file.write(wave_data)
-		temp_file.close()
-
-		# Play the temporary file
-		if self.voicePlayer is None:
-			self.voicePlayer = QMediaPlayer()
-		self.voicePlayer.setMedia(QMediaContent(QUrl.fromLocalFile(temp_file.name)))
-		self.voicePlayer.play()
-		
-		# Delete the temporary file after playing
-		os.unlink(temp_file.name)
+	def deliverSpeech(self, utterance, future):
+		# Runs on the worker thread that finished the future: the audio goes to the GUI thread through signals
+		if not future.cancelled() and future.exception() is None:
+			self.voiceOutput.chunkReady.emit(utterance, future.result())
+		self.voiceOutput.finished.emit(utterance)
 
 	def timeToMs(self, timeStr):  # CHANGE HERE
 		h, m, s = map(float, timeStr.split(":"))
@@ -549,117 +1017,100 @@ class VideoPlayer(QWidget):
 		if event.button() == Qt.LeftButton:
 			self.start_press_time = self.mediaPlayer.position()
 			# Start recording the trajectory
-			offset = QPoint(self.videoWidget.offset().x() + self.videoWidget.size().width() / 2, self.videoWidget.offset().y() + self.videoWidget.size().height() / 2)
-			size_w = self.videoWidget.size().width() / self.videoWidget.nativeSize().width()
-			size_h = self.videoWidget.size().height() / self.videoWidget.nativeSize().height()
-			scale = self.videoWidget.size().height() if size_w > size_h else self.videoWidget.size().width()
-			self.trajectory.append((self.start_press_time, self.mediaPlayer.position(), float(event.pos().x() - offset.x()) / scale, float(event.pos().y() - offset.y()) / scale))
-			self.trajectory.sort(key = lambda a: a[0])
+			self.recordTrajectoryPoint(event)
 		elif event.button() == Qt.RightButton:
 			# Clear the trajectory and record the time
-			self.clear_events.append(self.mediaPlayer.position())
+			clear_time = self.mediaPlayer.position()
+			self.clear_events.append(clear_time)
 			self.clear_events.sort()
+			self.journal.record("clear", clear_time)
+			self.countTrajectoryGroups()
+			self.updateTrajectoryOverlay()
 
 	def mouseMoveEvent(self, event):
 		if event.buttons() == Qt.LeftButton:
 			# Continue recording the trajectory
-			offset = QPoint(self.videoWidget.offset().x() + self.videoWidget.size().width() / 2, self.videoWidget.offset().y() + self.videoWidget.size().height() / 2)
-			size_w = self.videoWidget.size().width() / self.videoWidget.nativeSize().width()
-			size_h = self.videoWidget.size().height() / self.videoWidget.nativeSize().height()
-			scale = self.videoWidget.size().height() if size_w > size_h else self.videoWidget.size().width()
-			self.trajectory.append((self.start_press_time, self.mediaPlayer.position(), float(event.pos().x() - offset.x()) / scale, float(event.pos().y() - offset.y()) / scale))
-			self.trajectory.sort(key = lambda a: a[0])
+			self.recordTrajectoryPoint(event)
+
+	def recordTrajectoryPoint(self, event):
+		geometry = self.videoGeometry()
+		if geometry is None:
+			return
+		offset, scale = geometry
+		point = (self.start_press_time, self.mediaPlayer.position(), float(event.pos().x() - offset.x()) / scale, float(event.pos().y() - offset.y()) / scale)
+		self.trajectory.append(point)
+		self.trajectoryOverlay.addPoint(*point)
+		if self.start_press_time is not None:
+			self.trajectoryGroupCounts[bisect_right(self.clear_events, point[1])] += 1
+			self.journal.record_point(point)
+		self.updateTrajectoryOverlay()
 
 	def mouseReleaseEvent(self, event):
 		self.start_press_time = None
 		self.updateTrajectoryTable()
 
 	def updateTrajectoryOverlay(self):
-		# Clear the previous drawing
-#        self.graphicsScene.clear()
-
-		# Get the current playback position
-		position = self.mediaPlayer.position()
-
-		# Set the pen for drawing
-		pen = QPen(Qt.red, 3)  # Set pen color and thickness
+		# Show the trajectory up to the current playback position
+		self.trajectoryOverlay.update(self.mediaPlayer.position(), self.clear_events)
 
-		for i in self.drawnItems:
-			self.graphicsScene.removeItem(i)
-		self.drawnItems = []
-
-		# Draw the trajectory up to the current position
-		for i in range(1, len(self.trajectory)):
-			prev_start_press_time, prev_time, prev_x, prev_y = self.trajectory[i - 1]
-			start_press_time, curr_time, curr_x, curr_y = self.trajectory[i]
-			offset = QPoint(self.videoWidget.offset().x() + self.videoWidget.size().width() / 2, self.videoWidget.offset().y() + self.videoWidget.size().height() / 2)
-			size_w = self.videoWidget.size().width() / self.videoWidget.nativeSize().width()
-			size_h = self.videoWidget.size().height() / self.videoWidget.nativeSize().height()
-			scale = self.videoWidget.size().height() if size_w > size_h else self.videoWidget.size().width()
-			prev_x *= scale
-			prev_y *= scale
-			curr_x *= scale
-			curr_y *= scale
-			if prev_start_press_time != start_press_time or start_press_time is None:
-				continue
-
-			if curr_time > position:
-				break
-
-			if any(curr_time <= clear_time and clear_time < position for clear_time in self.clear_events):
-				continue
-
-			self.drawnItems.append(self.graphicsScene.addLine(prev_x + offset.x(), prev_y + offset.y(), curr_x + offset.x(), curr_y + offset.y(), pen))
-
-		self.graphicsView.setScene(self.graphicsScene)
+	def countTrajectoryGroups(self):
+		counts = [0] * (len(self.clear_events) + 1)
+		for t in self.trajectory.times:
+			counts[bisect_right(self.clear_events, t)] += 1
+		self.trajectoryGroupCounts = counts
 
 	def updateTrajectoryTable(self):
-		self.trajectoryTable.clear()
-		thumbnails = self.createThumbnails()
-		self.trajectoryTable.setRowCount(len(thumbnails))
-		for row, (start_time, thumbnail, clear_time) in enumerate(thumbnails):
+		# One row per clear event; only the groups whose points changed are rendered again, in the background
+		self.trajectoryTable.setRowCount(len(self.clear_events))
+		columns = None
+		for row, clear_time in enumerate(self.clear_events):
+			key = (clear_time, self.trajectoryGroupCounts[row])
+			time_item = self.trajectoryTable.item(row, 0)
+			if time_item is not None and time_item.data(Qt.UserRole + 1) == key:
+				continue
+			lower = self.clear_events[row - 1] if row > 0 else 0
+			thumbnail, start_time = self.thumbnails.get(key, (None, lower))
 			time_item = QTableWidgetItem(self.formatTime(start_time))
 			time_item.setData(Qt.UserRole, clear_time) # Store only clear_time
+			time_item.setData(Qt.UserRole + 1, key)
 			self.trajectoryTable.setItem(row, 0, time_item)
 
 			thumbnail_item = QTableWidgetItem()
 			thumbnail_item.setData(Qt.DecorationRole, thumbnail)
 			self.trajectoryTable.setItem(row, 1, thumbnail_item)
+			self.trajectoryTable.setRowHeight(row, THUMBNAIL_SIZE[1])  # Set the row height to match the thumbnail
+
+			if self.trajectoryTable.cellWidget(row, 2) is None:
+				self.trajectoryTable.setCellWidget(row, 2, self.removeTrajectoryButton())
+
+			if thumbnail is None and key not in self.thumbnailJobs:
+				if columns is None:
+					self.trajectory.ensure_sorted()
+					columns = [array("d", column) for column in (self.trajectory.start_times, self.trajectory.times, self.trajectory.xs, self.trajectory.ys)]
+				job = ThumbnailJob(key, lower, columns)
+				job.signals.finished.connect(self.thumbnailFinished)
+				self.thumbnailJobs[key] = job
+				self.thumbnailPool.start(job)
+
+	def thumbnailFinished(self, key, image, start_time):
+		self.thumbnailJobs.pop(key, None)
+		row = self.clear_events.index(key[0]) if key[0] in self.clear_events else -1
+		if start_time is None:
+			start_time = self.clear_events[row - 1] if row > 0 else 0
+		self.thumbnails[key] = (image, start_time)
+		time_item = self.trajectoryTable.item(row, 0) if row >= 0 else None
+		if time_item is not None and time_item.data(Qt.UserRole + 1) == key:
+			time_item.setText(self.formatTime(start_time))
+			self.trajectoryTable.item(row, 1).setData(Qt.DecorationRole, image)
+
+	def removeTrajectoryButton(self):
+		def _remove():
+			# Get the row from the clicked button
+			self.removeTrajectoryRow(self.trajectoryTable.indexAt(button.pos()).row())
 
-			remove_button = QPushButton('Remove')
-			remove_function = (lambda r: lambda: self.removeTrajectoryRow(r))(row)  # Closure to capture the row value
-			remove_button.clicked.connect(remove_function)
-			self.trajectoryTable.setCellWidget(row, 2, remove_button)
-
-			self.trajectoryTable.setRowHeight(row, thumbnail.height())  # Set the row height to match the thumbnail
-
-	def createThumbnails(self):
-		thumbnails = []
-		start_index = 0
-
-		for clear_time in self.clear_events:
-			thumbnail = QPixmap(80, 60)
-			thumbnail.fill(Qt.white)  # Fill the thumbnail with a white background
-			painter = QPainter(thumbnail)
-			painter.setPen(QColor(Qt.red))  # Set the pen color to red
-
-			for i in range(start_index, len(self.trajectory) - 1):
-				if self.trajectory[i][1] < clear_time:
-					if self.trajectory[i][0] != self.trajectory[i+1][0]:
-						continue
-					x1 = (self.trajectory[i][2] + 1) / 2 * thumbnail.width()
-					y1 = (self.trajectory[i][3] + 1) / 2 * thumbnail.height()
-					x2 = (self.trajectory[i + 1][2] + 1) / 2 * thumbnail.width()
-					y2 = (self.trajectory[i + 1][3] + 1) / 2 * thumbnail.height()
-					painter.drawLine(x1, y1, x2, y2)
-				else:
-					start_index = i
-					break
-
-			painter.end()
-			thumbnails.append((self.trajectory[start_index][0], thumbnail, clear_time))
-
-		return thumbnails
+		button = QPushButton('Remove')
+		button.clicked.connect(_remove)
+		return button
 
 	def selectTrajectory(self, index):  # CHANGE HERE
 		row = index.row()
@@ -671,11 +1122,12 @@ class VideoPlayer(QWidget):
 
 	def removeTrajectoryRow(self, row):
 		clear_time = self.trajectoryTable.item(row, 0).data(Qt.UserRole)
-		clear_index = self.clear_events.index(clear_time)
-		start_time = self.clear_events[clear_index - 1] if clear_index > 0 else 0
-		
-		self.trajectory = [t for t in self.trajectory if not (start_time <= t[1] < clear_time)]
-		self.clear_events.remove(clear_time)
+		self.trajectory = remove_clear_event(self.trajectory, self.clear_events, clear_time)
+		self.journal.record("remove_clear", clear_time)
+		self.countTrajectoryGroups()
+		self.trajectoryOverlay.rebuild(self.trajectory)
+		self.updateTrajectoryOverlay()
+		self.scheduler.reschedule()
 		self.trajectoryTable.removeRow(row)
 		self.updateTrajectoryTable()
 
@@ -0,0 +1,163 @@
+import os, glob, json, threading
+from concurrent.futures import ThreadPoolExecutor
+from trajectory_store import TrajectoryStore, load_trajectory, sidecar_filename, fsync_directory
+
+# A journal this large is folded into the snapshot at the next autosave
+COMPACT_BYTES = 1024 * 1024
+
+def journal_filename(comments_filename):
+	base = comments_filename[:-5] if comments_filename.endswith(".json") else comments_filename
+	return base + ".journal"
+
+def remove_clear_event(trajectory, clear_events, clear_time):
+	# Drop a clear event together with the points drawn between the previous one and it; returns the new trajectory
+	clear_index = clear_events.index(clear_time)
+	start_time = clear_events[clear_index - 1] if clear_index > 0 else 0
+	clear_events.remove(clear_time)
+	return trajectory.filter(lambda t: not (start_time <= t[1] < clear_time))
+
+def apply_edit(document, edit):
+	# Replay one journaled edit; rows are those of the player's comment list, which is sorted by offset
+	_, operation, *args = edit
+	comments = document["comments"]
+	if operation == "add":
+		row, offset, text = args
+		comments.insert(row, (offset, text))
+	elif operation == "update":
+		row, text = args
+		comments[row] = (comments[row][0], text)
+	elif operation == "remove":
+		comments.pop(args[0])
+	elif operation == "offset":
+		row, offset = args
+		comments[row] = (offset, comments[row][1])
+	elif operation == "stroke":
+		document["trajectory"].extend(args[0])
+	elif operation == "clear":
+		document["clear"].append(args[0])
+		document["clear"].sort()
+	elif operation == "remove_clear":
+		document["trajectory"] = remove_clear_event(document["trajectory"], document["clear"], args[0])
+	else:
+		raise ValueError("unknown journal operation %r" % operation)
+
+def load_document(filename):
+	# The snapshot in filename with the edits journaled after it replayed on top:
+	# {"comments": [(offset, text)], "trajectory": TrajectoryStore, "clear": [ms], "sequence": last edit, "journal_bytes": size of the journal}
+	document = {"comments": [], "trajectory": TrajectoryStore(), "clear": [], "sequence": 0, "journal_bytes": 0}
+	found = False
+	try:
+		with open(filename, "r", encoding="utf-8") as f:
+			data = json.load(f)
+		found = True
+		if isinstance(data, dict):
+			document.update(comments=data["comments"], trajectory=load_trajectory(filename, data), clear=data["clear"],
+							sequence=data.get("journal_sequence", 0))
+		else:
+			document["comments"] = data
+	except FileNotFoundError:
+		pass
+	# The player keeps its comments sorted, and the journaled rows refer to that order
+	document["comments"] = sorted((tuple(comment) for comment in document["comments"]), key=lambda comment: comment[0])
+
+	try:
+		with open(journal_filename(filename), "r", encoding="utf-8") as f:
+			found = True
+			for line in f:
+				try:
+					edit = json.loads(line)
+				except ValueError:
+					break  # The last line was cut off by a crash
+				if edit[0] > document["sequence"]:
+					apply_edit(document, edit)
+					document["sequence"] = edit[0]
+				document["journal_bytes"] += len(line.encode("utf-8"))
+	except FileNotFoundError:
+		pass
+	if not found:
+		raise FileNotFoundError(filename)
+	return document
+
+def write_snapshot(filename, comments, trajectory, clear_events, sequence):
+	# Trajectory points go to a binary sidecar next to the comments. Every snapshot writes a sidecar of its own and the
+	# previous one is deleted only after the JSON is replaced, so a crash in between leaves the old JSON with its old sidecar.
+	trajectory_filename = sidecar_filename(filename, sequence)
+	trajectory.save(trajectory_filename)
+	temp_filename = filename + ".tmp"
+	with open(temp_filename, "w", encoding="utf-8") as f:
+		json.dump({"comments": comments, "trajectory": [], "trajectory_file": os.path.basename(trajectory_filename),
+				   "clear": clear_events, "journal_sequence": sequence}, f, ensure_ascii=False, indent=2)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(temp_filename, filename)
+	fsync_directory(filename)
+	# Sidecars of earlier snapshots, including the unnumbered one of older versions
+	for old_filename in glob.glob(glob.escape(sidecar_filename(filename)[:-len(".bin")]) + "*.bin"):
+		if old_filename != trajectory_filename:
+			try:
+				os.unlink(old_filename)
+			except OSError:
+				pass
+
+class Journal:
+	# Append-only log of the edits made since the last snapshot, one JSON array per line: [sequence, operation, arguments...].
+	# Edits are buffered in memory and written by a background thread on flush; compact folds them into the snapshot.
+	def __init__(self, filename, sequence=0, size=0):
+		self.filename = filename  # the snapshot
+		self.journal_filename = journal_filename(filename)
+		self.sequence = sequence
+		self.size = size  # bytes in the journal file
+		self.pending = []
+		self.lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+
+	def record(self, operation, *args):
+		with self.lock:
+			self.sequence += 1
+			self.pending.append([self.sequence, operation, *args])
+
+	def record_point(self, point):
+		# Points of a stroke recorded between two flushes share one "stroke" edit
+		with self.lock:
+			if self.pending and self.pending[-1][1] == "stroke":
+				self.pending[-1][2].append(list(point))
+				return
+		self.record("stroke", [list(point)])
+
+	def take(self):
+		with self.lock:
+			edits, self.pending = self.pending, []
+			return edits
+
+	def flush(self, wait=False):
+		edits = self.take()
+		future = self.executor.submit(self.write, edits) if edits else None
+		if wait and future is not None:
+			future.result()
+
+	def write(self, edits):
+		lines = "".join(json.dumps(edit, ensure_ascii=False, separators=(",", ":")) + "\n" for edit in edits)
+		with open(self.journal_filename, "a", encoding="utf-8") as f:
+			f.write(lines)
+			f.flush()
+			os.fsync(f.fileno())
+		self.size += len(lines.encode("utf-8"))
+
+	def compact(self, comments, trajectory, clear_events, wait=False):
+		# Write a snapshot of the given state, which includes every edit recorded so far, then start an empty journal.
+		# Runs after the pending writes; edits recorded meanwhile are appended to the new journal.
+		self.flush()
+		future = self.executor.submit(self.write_snapshot, comments, trajectory, clear_events, self.sequence)
+		if wait:
+			future.result()
+
+	def write_snapshot(self, comments, trajectory, clear_events, sequence):
+		write_snapshot(self.filename, comments, trajectory, clear_events, sequence)
+		# The snapshot records the last edit it includes, so a crash before the journal is emptied does not replay edits twice
+		with open(self.journal_filename, "w", encoding="utf-8"):
+			pass
+		self.size = 0
+
+	def close(self):
+		self.flush()
+		self.executor.shutdown(wait=True)
@@ -0,0 +1,89 @@
+import os, sys, json, time, threading
+from contextlib import contextmanager
+
+# 0: errors only, 1: a summary per stage (default), 2: also the per-comment tables
+VERBOSITY = int(os.environ.get("COMMENTPLAYER_VERBOSE", 1))
+
+def set_verbosity(level):
+	# Exported so that worker processes started later see the same level
+	global VERBOSITY
+	VERBOSITY = level
+	os.environ["COMMENTPLAYER_VERBOSE"] = str(level)
+
+def log(level, message, *args):
+	if VERBOSITY >= level:
+		print(message % args if args else message)
+
+def progress(**kwargs):
+	# Live progress bars, shown on a terminal unless quiet
+	from tqdm import tqdm
+	return tqdm(disable=VERBOSITY < 1 or not sys.stderr.isatty(), **kwargs)
+
+def percentiles(values):
+	values = sorted(values)
+	if not values:
+		return {"count": 0}
+	pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+	return {"count": len(values), "mean": sum(values) / len(values), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": values[-1]}
+
+class Metrics:
+	# Wall-clock seconds per pipeline stage, counters, single values and samples (such as latencies) of one run
+	def __init__(self):
+		self.started = time.perf_counter()
+		self.stages = {}
+		self.counters = {}
+		self.values = {}
+		self.samples = {}
+		self.lock = threading.Lock()
+
+	@contextmanager
+	def stage(self, name):
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add_time(name, time.perf_counter() - started)
+
+	def add_time(self, name, seconds):
+		with self.lock:
+			self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def set(self, name, value):
+		with self.lock:
+			self.values[name] = value
+
+	def sample(self, name, value):
+		with self.lock:
+			self.samples.setdefault(name, []).append(value)
+
+	def report(self):
+		with self.lock:
+			return {"total_seconds": time.perf_counter() - self.started, "stages": dict(self.stages), "counters": dict(self.counters),
+					"values": dict(self.values), "samples": {name: percentiles(values) for name, values in self.samples.items()}}
+
+	def write(self, filename):
+		with open(filename, "w", encoding="utf-8") as f:
+			json.dump(self.report(), f, indent=2, ensure_ascii=False)
+
+	def summary(self):
+		report = self.report()
+		lines = ["%-24s %8.2f sec" % (name, seconds) for name, seconds in report["stages"].items()]
+		for name, stats in report["samples"].items():
+			if stats["count"]:
+				lines.append("%-24s p50 %.1f, p95 %.1f, max %.1f (%d)" % (name, stats["p50"], stats["p95"], stats["max"], stats["count"]))
+		lines.append("%-24s %8.2f sec" % ("total", report["total_seconds"]))
+		return "\n".join(lines)
+
+_current = Metrics()
+
+def current():
+	return _current
+
+def reset():
+	global _current
+	_current = Metrics()
+	return _current
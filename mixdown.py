@@ -0,0 +1,109 @@
+import io, wave
+from collections import namedtuple
+import numpy as np
+
+# Silence is written in chunks of this many frames when streaming
+STREAM_CHUNK_FRAMES = 48000
+# Format of a track without any speech (VOICEVOX output: mono, 16 bit, 24kHz)
+WavParams = namedtuple("WavParams", "nchannels sampwidth framerate nframes comptype compname")
+EMPTY_PARAMS = WavParams(1, 2, 24000, 0, "NONE", "not compressed")
+
+def read_wav(wav_data):
+	with wave.open(io.BytesIO(wav_data), "rb") as w:
+		return w.getparams(), w.readframes(w.getnframes())
+
+def convert_frames(wav_data, params):
+	# Resample a segment whose format differs from the mixdown (rare: VOICEVOX output is uniform)
+	from pydub import AudioSegment
+	segment = AudioSegment.from_wav(io.BytesIO(wav_data))
+	segment = segment.set_frame_rate(params.framerate).set_channels(params.nchannels).set_sample_width(params.sampwidth)
+	return segment.raw_data
+
+class Mixdown:
+	# Lays speech segments out on a timeline in place of growing an AudioSegment with +=.
+	# By default segments are kept as they arrive and written once into a preallocated buffer on export;
+	# with a filename the WAV is streamed to disk as segments are appended so memory use stays constant.
+	def __init__(self, filename=None):
+		self.filename = filename
+		self.params = None
+		self.lead_ms = 0  # silence requested before the sample format is known
+		self.frames = 0
+		self.placed = []  # (frame offset, raw frames) when not streaming
+		self.writer = None
+
+	def __len__(self):
+		# Length in milliseconds, rounded the same way as len(AudioSegment)
+		if self.params is None:
+			return self.lead_ms
+		return round(1000 * self.frames / self.params.framerate)
+
+	def pad_to(self, position_ms):
+		# Comment offsets on the output timeline are floats; lengths stay whole milliseconds
+		silence_ms = max(0, round(position_ms) - len(self))
+		if self.params is None:
+			self.lead_ms += silence_ms
+		else:
+			self.add_silence(int(silence_ms * self.params.framerate / 1000))
+
+	def add_silence(self, frames):
+		if self.writer is not None:
+			chunk = self.silence_bytes(min(frames, STREAM_CHUNK_FRAMES))
+			remaining = frames
+			while remaining > 0:
+				count = min(remaining, STREAM_CHUNK_FRAMES)
+				self.writer.writeframesraw(chunk[:count * self.frame_size()])
+				remaining -= count
+		self.frames += frames
+
+	def frame_size(self):
+		return self.params.sampwidth * self.params.nchannels
+
+	def silence_bytes(self, frames):
+		return (b"\x80" if self.params.sampwidth == 1 else b"\x00") * (frames * self.frame_size())
+
+	def append(self, wav_data):
+		# Place a segment right after the current end of the timeline and return its duration in milliseconds
+		params, raw = read_wav(wav_data)
+		if self.params is None:
+			self.params = params._replace(nframes=0)
+			if self.filename is not None:
+				self.writer = wave.open(self.filename, "wb")
+				self.writer.setparams(self.params)
+			lead = self.lead_ms
+			self.lead_ms = 0
+			self.add_silence(int(lead * params.framerate / 1000))
+		elif params[:3] != self.params[:3]:
+			raw = convert_frames(wav_data, self.params)
+		frames = len(raw) // self.frame_size()
+
+		if self.writer is not None:
+			self.writer.writeframesraw(raw)
+		else:
+			self.placed.append((self.frames, raw))
+		self.frames += frames
+		return round(1000 * frames / self.params.framerate)
+
+	def render(self):
+		# Write every segment straight into one preallocated buffer at its offset
+		size = self.frame_size()
+		buffer = np.full(self.frames * size, 128 if self.params.sampwidth == 1 else 0, dtype=np.uint8)
+		for offset, raw in self.placed:
+			buffer[offset * size:offset * size + len(raw)] = np.frombuffer(raw, dtype=np.uint8)
+		return buffer
+
+	def export(self, filename=None):
+		filename = filename or self.filename
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+			return filename
+		if self.params is None:
+			# Nothing was synthesized: write the requested silence only
+			self.params = EMPTY_PARAMS
+			self.add_silence(int(self.lead_ms * self.params.framerate / 1000))
+			self.lead_ms = 0
+		with wave.open(filename, "wb") as w:
+			w.setparams(self.params)
+			w.writeframes(self.render().tobytes())
+		self.placed = []
+		return filename
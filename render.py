@@ -0,0 +1,413 @@
+import os, json, time, shutil, hashlib, tempfile, resource
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import ffmpeg
+from metrics import current as current_metrics, log, progress
+from trajectory import TrajectoryRenderer, trajectory_window
+from captions import TTF_FONTFILE, FONT_SIZE, RENDER_VERSION as CAPTION_RENDER_VERSION, CaptionTrack, prerender_captions
+
+# Frames handed to a compositing worker at a time
+DEFAULT_BATCH_FRAMES = 16
+# Frame bytes sent to the compositing workers and not yet written to the encoder, counting the composited copy
+MAX_IN_FLIGHT_BYTES = int(os.environ.get("COMMENTPLAYER_RENDER_IN_FLIGHT", 512 * 1024 * 1024))
+# Longest piece of a speed segment rendered and cached on its own
+DEFAULT_CHUNK_FRAMES = 300
+# Bump when the look of rendered frames changes so that cached chunks are rendered again
+RENDER_CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.environ.get("COMMENTPLAYER_RENDER_CACHE",
+	os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "commentplayer", "render"))
+DEFAULT_CACHE_SIZE = int(os.environ.get("COMMENTPLAYER_RENDER_CACHE_SIZE", 4 * 1024 * 1024 * 1024))
+
+def probe_video(filename):
+	# (width, height, frames per second, frame rate as given by ffmpeg, duration in seconds)
+	info = ffmpeg.probe(filename)
+	stream = next(s for s in info["streams"] if s["codec_type"] == "video")
+	rate = stream.get("avg_frame_rate", "0/0")
+	if rate.startswith("0"):
+		rate = stream["r_frame_rate"]
+	num, den = rate.split("/")
+	duration = float(stream.get("duration") or info["format"]["duration"])
+	return int(stream["width"]), int(stream["height"]), float(num) / float(den), rate, duration
+
+def output_timeline(segments, duration, fps):
+	# Place speed segments on the output: [(source start, source end, speed, first output frame, frame count)]
+	timeline = []
+	out_time = 0
+	for start, end, speed in segments:
+		end = duration if end is None else min(end, duration)
+		if end <= start:
+			continue
+		first = round(out_time * fps)
+		out_time += (end - start) / speed
+		timeline.append((start, end, speed, first, round(out_time * fps) - first))
+	return timeline
+
+def decode_segment(filename, start, end, speed, rate, width, height, count):
+	# Raw RGB frames of a source range, retimed by ffmpeg to the output frame rate
+	process = (ffmpeg.input(filename, ss=start, t=end - start)
+		.video.filter('setpts', '(PTS-STARTPTS)/%r' % speed).filter('fps', fps=rate)
+		.output('pipe:', format='rawvideo', pix_fmt='rgb24')
+		.global_args('-loglevel', 'error')
+		.run_async(pipe_stdout=True))
+	frame_size = width * height * 3
+	last = bytes(frame_size)
+	try:
+		for _ in range(count):
+			data = process.stdout.read(frame_size)
+			if len(data) < frame_size:
+				data = last  # Pad a segment that decoded short with its last frame
+			last = data
+			yield data
+	finally:
+		process.stdout.close()
+		process.kill()
+		process.wait()
+
+def frame_batches(filename, timeline, fps, rate, width, height, batch_frames):
+	# Yields (raw frames, [(output time, source time)]) in output order
+	raw, times = [], []
+	for start, end, speed, first, count in timeline:
+		for j, data in enumerate(decode_segment(filename, start, end, speed, rate, width, height, count)):
+			raw.append(data)
+			times.append(((first + j) / fps, start + j * speed / fps))
+			if len(raw) == batch_frames:
+				yield b"".join(raw), times
+				raw, times = [], []
+	if raw:
+		yield b"".join(raw), times
+
+def open_encoder(output_filename, width, height, rate, duration, audio_filename=None, codec='libx264'):
+	streams = [ffmpeg.input('pipe:', format='rawvideo', pix_fmt='rgb24', s='%dx%d' % (width, height), framerate=rate).video]
+	if audio_filename is not None:
+		streams.append(ffmpeg.input(audio_filename).audio)
+	return (ffmpeg.output(*streams, output_filename, vcodec=codec, pix_fmt='yuv420p', acodec='aac', t=duration)
+		.global_args('-loglevel', 'error')
+		.overwrite_output()
+		.run_async(pipe_stdin=True))
+
+_worker = {}
+
+def init_compositor(trajectory, clear_events, captions, width, font_path, size):
+	# Each worker process keeps its own incremental trajectory layer and caption cache
+	_worker["trajectory"] = TrajectoryRenderer(trajectory, clear_events)
+	_worker["captions"] = CaptionTrack(captions, width, font_path, size)
+
+def composite_frames(raw, times, width, height):
+	# The composited frames, with the seconds spent on the trajectory and on the captions
+	frames = np.frombuffer(raw, dtype=np.uint8).reshape(-1, height, width, 3)
+	out = bytearray()
+	trajectory_seconds = caption_seconds = 0.0
+	for frame, (out_t, src_t) in zip(frames, times):
+		# The trajectory was drawn against the source timeline, captions against the output one
+		started = time.perf_counter()
+		frame = _worker["trajectory"].render(frame, src_t)
+		drawn = time.perf_counter()
+		frame = _worker["captions"].composite(frame, out_t)
+		trajectory_seconds += drawn - started
+		caption_seconds += time.perf_counter() - drawn
+		out += frame.tobytes()
+	return bytes(out), trajectory_seconds, caption_seconds
+
+def cpu_seconds():
+	usage = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+	return sum(u.ru_utime + u.ru_stime for u in usage)
+
+def record_timings(trajectory_seconds, caption_seconds, pipe_seconds, finish_seconds=0.0):
+	# Time spent in the workers, summed over all of them. The encoder runs alongside: it shows as time blocked writing
+	# frames into its pipe when it cannot keep up, and as the wait for it to finish after the last frame.
+	metrics = current_metrics()
+	metrics.add_time("trajectory_compositing", trajectory_seconds)
+	metrics.add_time("caption_compositing", caption_seconds)
+	metrics.add_time("encoder_pipe_write", pipe_seconds)
+	metrics.add_time("encoder_finish", finish_seconds)
+
+def record_render(frames, elapsed, cpu):
+	metrics = current_metrics()
+	metrics.set("frames", frames)
+	metrics.set("fps", frames / elapsed if elapsed > 0 else 0)
+	metrics.set("cpu_percent", 100 * cpu / elapsed / (os.cpu_count() or 1) if elapsed > 0 else 0)
+
+def render_video(video_filename, segments, captions, trajectory, clear_events, audio_filename, output_filename,
+				 workers=None, batch_frames=DEFAULT_BATCH_FRAMES, font_path=TTF_FONTFILE, size=FONT_SIZE, codec='libx264'):
+	# Decode with ffmpeg, composite trajectory and captions in worker processes, and pipe the frames in order into one encoder
+	workers = workers or os.cpu_count() or 1
+	width, height, fps, rate, duration = probe_video(video_filename)
+	timeline = output_timeline(segments, duration, fps)
+	total_frames = sum(count for *_, count in timeline)
+	metrics = current_metrics()
+	with metrics.stage("caption_rendering"):
+		metrics.count("captions_rendered", prerender_captions([text for text, _, _ in captions], width, font_path, size, processes=workers))
+
+	started = time.perf_counter()
+	cpu_started = cpu_seconds()
+	encoder = open_encoder(output_filename, width, height, rate, total_frames / fps, audio_filename, codec)
+	init_args = (list(trajectory), list(clear_events), captions, width, font_path, size)
+	bar = progress(total=total_frames, unit="frame")
+	# Smaller batches for large frames, so that two batches per worker still fit in MAX_IN_FLIGHT_BYTES
+	frame_bytes = 2 * width * height * 3  # raw and composited
+	batch_frames = max(1, min(batch_frames, MAX_IN_FLIGHT_BYTES // (frame_bytes * workers * 2)))
+	batches = frame_batches(video_filename, timeline, fps, rate, width, height, batch_frames)
+
+	def write(result, count):
+		data, trajectory_seconds, caption_seconds = result
+		write_started = time.perf_counter()
+		encoder.stdin.write(data)
+		record_timings(trajectory_seconds, caption_seconds, time.perf_counter() - write_started)
+		bar.update(count)
+
+	try:
+		if workers == 1:
+			init_compositor(*init_args)
+			for raw, times in batches:
+				write(composite_frames(raw, times, width, height), len(times))
+		else:
+			with ProcessPoolExecutor(max_workers=workers, initializer=init_compositor, initargs=init_args) as pool:
+				# Keep every worker busy while writing finished batches in order, within MAX_IN_FLIGHT_BYTES
+				pending = deque()
+				in_flight = 0
+				for raw, times in batches:
+					while pending and (len(pending) >= workers * 2 or in_flight + frame_bytes * len(times) > MAX_IN_FLIGHT_BYTES):
+						future, count = pending.popleft()
+						in_flight -= frame_bytes * count
+						write(future.result(), count)
+					pending.append((pool.submit(composite_frames, raw, times, width, height), len(times)))
+					in_flight += frame_bytes * len(times)
+				while pending:
+					future, count = pending.popleft()
+					write(future.result(), count)
+	finally:
+		bar.close()
+		with metrics.stage("encoder_finish"):
+			encoder.stdin.close()
+			encoder.wait()
+
+	elapsed = time.perf_counter() - started
+	cpu = cpu_seconds() - cpu_started
+	metrics.add_time("render", elapsed)
+	record_render(total_frames, elapsed, cpu)
+	log(1, "Rendered %d frames in %.1f sec (%.1f fps, CPU %.0f%% of %d cores)" % (
+		total_frames, elapsed, total_frames / elapsed if elapsed > 0 else 0, 100 * cpu / elapsed / (os.cpu_count() or 1) if elapsed > 0 else 0, os.cpu_count() or 1))
+	return output_filename
+
+def captions_in_range(captions, start, end):
+	# Captions overlapping [start, end) on the output timeline, re-timed to start at 0
+	return [(text, caption_start - start, duration) for text, caption_start, duration in captions
+			if caption_start < end and caption_start + duration > start]
+
+def render_part(args):
+	# Render one source range with its captions and trajectory to its own file (runs in a worker process)
+	(video_filename, entry, captions, trajectory, clear_events, width, height, fps, rate,
+	 font_path, size, codec, part_filename) = args
+	start, end, speed, first, count = entry
+	init_compositor(trajectory, clear_events, captions, width, font_path, size)
+	encoder = open_encoder(part_filename, width, height, rate, count / fps, None, codec)
+	timings = [0.0, 0.0, 0.0, 0.0]  # trajectory, captions, encoder pipe writes, encoder finish
+	try:
+		for raw, times in frame_batches(video_filename, [(start, end, speed, 0, count)], fps, rate, width, height, DEFAULT_BATCH_FRAMES):
+			data, trajectory_seconds, caption_seconds = composite_frames(raw, times, width, height)
+			write_started = time.perf_counter()
+			encoder.stdin.write(data)
+			timings[0] += trajectory_seconds
+			timings[1] += caption_seconds
+			timings[2] += time.perf_counter() - write_started
+	finally:
+		finish_started = time.perf_counter()
+		encoder.stdin.close()
+		encoder.wait()
+		timings[3] = time.perf_counter() - finish_started
+	return part_filename, count, timings
+
+def concat_parts(part_filenames, audio_filename, output_filename, duration, directory):
+	# Join encoded parts with the concat demuxer, copying the video stream as is
+	list_filename = os.path.join(directory, "parts.txt")
+	with open(list_filename, "w") as f:
+		for part_filename in part_filenames:
+			f.write("file '%s'\n" % os.path.abspath(part_filename).replace("'", "'\\''"))
+	streams = [ffmpeg.input(list_filename, format='concat', safe=0).video]
+	if audio_filename is not None:
+		streams.append(ffmpeg.input(audio_filename).audio)
+	(ffmpeg.output(*streams, output_filename, vcodec='copy', acodec='aac', t=duration)
+		.global_args('-loglevel', 'error')
+		.overwrite_output()
+		.run())
+
+def render_video_segments(video_filename, segments, captions, trajectory, clear_events, audio_filename, output_filename,
+						  workers=None, font_path=TTF_FONTFILE, size=FONT_SIZE, codec='libx264'):
+	# Render every speed segment in its own process and concatenate the parts without re-encoding
+	workers = workers or os.cpu_count() or 1
+	width, height, fps, rate, duration = probe_video(video_filename)
+	timeline = output_timeline(segments, duration, fps)
+	total_frames = sum(count for *_, count in timeline)
+	metrics = current_metrics()
+	with metrics.stage("caption_rendering"):
+		metrics.count("captions_rendered", prerender_captions([text for text, _, _ in captions], width, font_path, size, processes=workers))
+
+	started = time.perf_counter()
+	cpu_started = cpu_seconds()
+	directory = tempfile.mkdtemp(prefix="commentplayer-parts-", dir=os.path.dirname(os.path.abspath(output_filename)))
+	try:
+		tasks = []
+		for i, entry in enumerate(timeline):
+			start, end, speed, first, count = entry
+			tasks.append((video_filename, entry, captions_in_range(captions, first / fps, (first + count) / fps),
+						  trajectory_window(trajectory, clear_events, start * 1000, end * 1000), list(clear_events),
+						  width, height, fps, rate, font_path, size, codec, os.path.join(directory, "part%05d.mp4" % i)))
+		bar = progress(total=total_frames, unit="frame")
+		with metrics.stage("render"), ProcessPoolExecutor(max_workers=workers) as pool:
+			# Longest segments first so that one long segment does not finish last on its own
+			futures = {}
+			for task in sorted(tasks, key=lambda task: -task[1][4]):
+				futures[task[-1]] = pool.submit(render_part, task)
+			for task in tasks:
+				_, count, timings = futures[task[-1]].result()
+				record_timings(*timings)
+				bar.update(count)
+		bar.close()
+		with metrics.stage("concat"):
+			concat_parts([task[-1] for task in tasks], audio_filename, output_filename, total_frames / fps, directory)
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+
+	elapsed = time.perf_counter() - started
+	cpu = cpu_seconds() - cpu_started
+	record_render(total_frames, elapsed, cpu)
+	log(1, "Rendered %d frames in %d segments in %.1f sec (%.1f fps, CPU %.0f%% of %d cores)" % (
+		total_frames, len(timeline), elapsed, total_frames / elapsed if elapsed > 0 else 0, 100 * cpu / elapsed / (os.cpu_count() or 1) if elapsed > 0 else 0, os.cpu_count() or 1))
+	return output_filename
+
+def timeline_chunks(timeline, fps, chunk_frames=DEFAULT_CHUNK_FRAMES):
+	# Split the segments into chunks of at most chunk_frames frames, counted from the start of their segment so that
+	# an edit that only moves a segment on the output keeps its chunks
+	chunks = []
+	for start, end, speed, first, count in timeline:
+		for j in range(0, count, chunk_frames):
+			n = min(chunk_frames, count - j)
+			chunks.append((start + j * speed / fps, min(end, start + (j + n) * speed / fps), speed, first + j, n))
+	return chunks
+
+def clear_events_in_range(clear_events, start_ms, end_ms):
+	# The clear events the trajectory renderer looks at between start_ms and end_ms (clear_events sorted)
+	return clear_events[max(0, bisect_left(clear_events, start_ms) - 1):bisect_right(clear_events, end_ms)]
+
+class RenderCache:
+	# Encoded chunks of exported videos, keyed by everything that goes into their frames. Least recently used
+	# chunks are deleted once the cache grows past max_bytes.
+	def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		os.makedirs(directory, exist_ok=True)
+
+	def key(self, video_filename, chunk, captions, trajectory, clear_events, width, height, rate, font_path, size, codec):
+		# The chunk's place on the output is left out: captions and frames are timed from its first frame
+		start, end, speed, _, count = chunk
+		st = os.stat(video_filename)
+		source = json.dumps([RENDER_CACHE_VERSION, CAPTION_RENDER_VERSION, os.path.abspath(video_filename), st.st_size, st.st_mtime_ns,
+							 start, end, speed, count, captions, trajectory, clear_events, width, height, rate,
+							 os.path.abspath(font_path), size, codec], ensure_ascii=False, separators=(",", ":"))
+		return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key[:2], key + ".mp4")
+
+	def get(self, key):
+		path = self.path(key)
+		try:
+			os.utime(path)  # mtime doubles as the LRU timestamp
+		except OSError:
+			return None
+		return path
+
+	def temp_path(self, key):
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		return "%s.%d.tmp.mp4" % (path[:-4], os.getpid())
+
+	def evict(self, keep=()):
+		found = []
+		for root, _, files in os.walk(self.directory):
+			for name in files:
+				if name.endswith(".mp4") and ".tmp" not in name:
+					path = os.path.join(root, name)
+					st = os.stat(path)
+					found.append((st.st_mtime, path, st.st_size))
+		total = sum(size for _, _, size in found)
+		for _, path, size in sorted(found):
+			if total <= self.max_bytes:
+				break
+			if path not in keep:
+				os.unlink(path)
+				total -= size
+
+_default_cache = None
+
+def default_cache():
+	global _default_cache
+	if _default_cache is None:
+		_default_cache = RenderCache()
+	return _default_cache
+
+def render_video_chunks(video_filename, segments, captions, trajectory, clear_events, audio_filename, output_filename,
+						workers=None, font_path=TTF_FONTFILE, size=FONT_SIZE, codec='libx264', chunk_frames=DEFAULT_CHUNK_FRAMES, cache=None):
+	# Like render_video_segments, with the segments cut into chunks that are kept in the render cache:
+	# only chunks whose captions, trajectory or source range changed since an earlier export are rendered again
+	workers = workers or os.cpu_count() or 1
+	cache = cache or default_cache()
+	width, height, fps, rate, duration = probe_video(video_filename)
+	chunks = timeline_chunks(output_timeline(segments, duration, fps), fps, chunk_frames)
+	total_frames = sum(count for *_, count in chunks)
+	trajectory = list(trajectory)
+	clear_events = sorted(clear_events)
+
+	started = time.perf_counter()
+	cpu_started = cpu_seconds()
+	paths = []
+	tasks = {}  # cache path -> render_part arguments of the chunks missing from the cache
+	for chunk in chunks:
+		start, end, speed, first, count = chunk
+		chunk_captions = captions_in_range(captions, first / fps, (first + count) / fps)
+		chunk_trajectory = trajectory_window(trajectory, clear_events, start * 1000, end * 1000)
+		chunk_clear_events = clear_events_in_range(clear_events, start * 1000, end * 1000)
+		key = cache.key(video_filename, chunk, chunk_captions, chunk_trajectory, chunk_clear_events, width, height, rate, font_path, size, codec)
+		path = cache.get(key)
+		if path is None:
+			path = cache.path(key)
+			if path not in tasks:
+				tasks[path] = (video_filename, chunk, chunk_captions, chunk_trajectory, chunk_clear_events,
+							   width, height, fps, rate, font_path, size, codec, cache.temp_path(key))
+		paths.append(path)
+	rendered_frames = sum(task[1][4] for task in tasks.values())
+	metrics = current_metrics()
+	metrics.set("chunks", len(chunks))
+	metrics.set("chunks_rendered", len(tasks))
+	with metrics.stage("caption_rendering"):
+		metrics.count("captions_rendered", prerender_captions([text for task in tasks.values() for text, _, _ in task[2]], width, font_path, size, processes=workers))
+
+	if tasks:
+		bar = progress(total=rendered_frames, unit="frame")
+		with metrics.stage("render"), ProcessPoolExecutor(max_workers=workers) as pool:
+			# Longest chunks first so that one long chunk does not finish last on its own
+			futures = [(path, pool.submit(render_part, task)) for path, task in sorted(tasks.items(), key=lambda item: -item[1][1][4])]
+			for path, future in futures:
+				part_filename, count, timings = future.result()
+				os.replace(part_filename, path)
+				record_timings(*timings)
+				bar.update(count)
+		bar.close()
+
+	directory = tempfile.mkdtemp(prefix="commentplayer-parts-", dir=os.path.dirname(os.path.abspath(output_filename)))
+	try:
+		with metrics.stage("concat"):
+			concat_parts(paths, audio_filename, output_filename, total_frames / fps, directory)
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+	cache.evict(keep=set(paths))
+
+	elapsed = time.perf_counter() - started
+	cpu = cpu_seconds() - cpu_started
+	record_render(rendered_frames, elapsed, cpu)
+	log(1, "Rendered %d of %d chunks (%d of %d frames, %d chunks from the render cache) in %.1f sec (CPU %.0f%% of %d cores)" % (
+		len(tasks), len(chunks), rendered_frames, total_frames, len(chunks) - len(tasks), elapsed, 100 * cpu / elapsed / (os.cpu_count() or 1) if elapsed > 0 else 0, os.cpu_count() or 1))
+	return output_filename
@@ -0,0 +1,90 @@
+import os, sys, json
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from journal import Journal, apply_edit, load_document, write_snapshot, journal_filename
+from trajectory_store import TrajectoryStore, sidecar_filename
+
+def write_journal(filename, edits, tail=""):
+	with open(journal_filename(filename), "w", encoding="utf-8") as f:
+		for edit in edits:
+			f.write(json.dumps(edit) + "\n")
+		f.write(tail)
+
+def sidecars(directory):
+	return sorted(name for name in os.listdir(directory) if name.endswith(".bin"))
+
+def test_load_document_replays_only_edits_after_the_snapshot(tmp_path):
+	filename = str(tmp_path / "v.mp4.comments.json")
+	write_snapshot(filename, [(0, "a"), (1000, "b")], TrajectoryStore([(0, 10, 0.1, 0.1)]), [], 2)
+	# Edits 1 and 2 are already in the snapshot: a crash came before the journal was emptied
+	write_journal(filename, [[1, "add", 0, 0, "a"], [2, "stroke", [[0, 10, 0.1, 0.1]]],
+							 [3, "add", 2, 2000, "c"], [4, "stroke", [[0, 20, 0.2, 0.2]]]])
+	document = load_document(filename)
+	assert document["comments"] == [(0, "a"), (1000, "b"), (2000, "c")]
+	assert document["trajectory"].to_list() == [[0, 10, 0.1, 0.1], [0, 20, 0.2, 0.2]]
+	assert document["sequence"] == 4
+
+def test_load_document_ignores_a_truncated_last_line(tmp_path):
+	filename = str(tmp_path / "v.mp4.comments.json")
+	write_snapshot(filename, [], TrajectoryStore(), [], 0)
+	write_journal(filename, [[1, "add", 0, 500, "kept"]], tail='[2,"add",1,900,"lo')
+	document = load_document(filename)
+	assert document["comments"] == [(500, "kept")]
+	assert document["sequence"] == 1
+
+def test_load_document_without_snapshot(tmp_path):
+	filename = str(tmp_path / "v.mp4.comments.json")
+	write_journal(filename, [[1, "add", 0, 500, "a"], [2, "clear", 800]])
+	document = load_document(filename)
+	assert document["comments"] == [(500, "a")]
+	assert document["clear"] == [800]
+
+def test_apply_edit_rows():
+	document = {"comments": [(0, "a"), (1000, "b"), (2000, "c")], "trajectory": TrajectoryStore(), "clear": []}
+	apply_edit(document, [1, "add", 1, 500, "x"])  # insert before row 1
+	assert document["comments"] == [(0, "a"), (500, "x"), (1000, "b"), (2000, "c")]
+	apply_edit(document, [2, "offset", 2, 1500])  # move in place, the row keeps its text
+	assert document["comments"] == [(0, "a"), (500, "x"), (1500, "b"), (2000, "c")]
+	apply_edit(document, [3, "update", 3, "d"])  # new text, same offset
+	assert document["comments"] == [(0, "a"), (500, "x"), (1500, "b"), (2000, "d")]
+	apply_edit(document, [4, "remove", 0])  # later rows move up
+	assert document["comments"] == [(500, "x"), (1500, "b"), (2000, "d")]
+
+def test_apply_edit_remove_clear():
+	document = {"comments": [], "trajectory": TrajectoryStore([(0, 100, 0, 0), (0, 600, 0, 0), (0, 1200, 0, 0)]), "clear": [500, 1000]}
+	apply_edit(document, [1, "remove_clear", 1000])  # points between the previous clear and this one go with it
+	assert document["clear"] == [500]
+	assert [point[1] for point in document["trajectory"]] == [100, 1200]
+
+def test_write_snapshot_sidecars(tmp_path):
+	filename = str(tmp_path / "v.mp4.comments.json")
+	# A sidecar from before snapshots were numbered
+	TrajectoryStore([(0, 1, 0, 0)]).save(sidecar_filename(filename))
+	write_snapshot(filename, [], TrajectoryStore([(0, 10, 0.1, 0.1)]), [], 3)
+	with open(filename, encoding="utf-8") as f:
+		assert json.load(f)["trajectory_file"] == os.path.basename(sidecar_filename(filename, 3))
+	assert sidecars(str(tmp_path)) == [os.path.basename(sidecar_filename(filename, 3))]
+
+	write_snapshot(filename, [], TrajectoryStore([(0, 10, 0.1, 0.1), (0, 20, 0.2, 0.2)]), [], 7)
+	assert sidecars(str(tmp_path)) == [os.path.basename(sidecar_filename(filename, 7))]
+	assert len(load_document(filename)["trajectory"]) == 2
+
+def test_journal_compact(tmp_path):
+	filename = str(tmp_path / "v.mp4.comments.json")
+	journal = Journal(filename)
+	journal.record("add", 0, 100, "a")
+	journal.record_point((0, 10, 0.1, 0.1))
+	journal.record_point((0, 20, 0.2, 0.2))  # same stroke edit as the previous point
+	journal.flush(wait=True)
+	document = load_document(filename)
+	assert document["sequence"] == 2
+	assert len(document["trajectory"]) == 2
+
+	journal.compact(document["comments"], document["trajectory"], document["clear"], wait=True)
+	assert journal.size == 0
+	assert os.path.getsize(journal_filename(filename)) == 0
+	journal.record("remove", 0)
+	journal.close()
+	document = load_document(filename)
+	assert document["comments"] == []
+	assert len(document["trajectory"]) == 2
+	assert document["sequence"] == 3
@@ -0,0 +1,26 @@
+import os, sys, wave
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mixdown import Mixdown
+
+def make_wav(path, ms, rate=24000):
+	with wave.open(path, "wb") as w:
+		w.setparams((1, 2, rate, 0, "NONE", "not compressed"))
+		w.writeframes(bytes(2 * rate * ms // 1000))
+	with open(path, "rb") as f:
+		return f.read()
+
+def test_pad_to_float_offsets_before_first_segment(tmp_path):
+	# Comments without speech leave only silence before the first segment, at float offsets
+	mixdown = Mixdown()
+	mixdown.pad_to(1500.0)
+	mixdown.pad_to(2000.4)
+	assert len(mixdown) == 2000
+	assert mixdown.append(make_wav(str(tmp_path / "segment.wav"), 500)) == 500
+	assert len(mixdown) == 2500
+
+def test_pad_to_float_offsets_without_segments(tmp_path):
+	mixdown = Mixdown()
+	mixdown.pad_to(250.0)
+	mixdown.pad_to(1000.6)
+	with wave.open(mixdown.export(str(tmp_path / "out.wav")), "rb") as w:
+		assert w.getnframes() == 24000 * 1001 // 1000
@@ -0,0 +1,88 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from timeline import CommentTimeline, compile_comment, compile_plan, cut_zones, kept_indices, skip_zones
+
+def entries(comments):
+	return [compile_comment(offset, text) for offset, text in comments]
+
+def test_skip_zones_nested_and_unpaired_brackets():
+	# A second "[" restarts the zone, a "]" without "[" and a "[" that is never closed are ignored
+	assert skip_zones([(0, "["), (100, "["), (200, "]"), (300, "]"), (400, "[")]) == [(100, 200)]
+	assert skip_zones([(0, "]"), (100, "["), (200, "]"), (300, "["), (400, "]")]) == [(100, 200), (300, 400)]
+
+def test_kept_indices_with_unpaired_brackets():
+	comments = entries([(0, "a"), (100, "]"), (200, "b"), (300, "["), (400, "c")])
+	zones = skip_zones((entry.offset, entry.text) for entry in comments)
+	assert zones == []
+	assert list(kept_indices(comments, zones)) == [0, 2, 4]
+
+def test_kept_indices_at_zone_boundaries():
+	# Comments at the first and the last millisecond of a zone are skipped with it
+	comments = entries([(999, "before"), (1000, "["), (1000, "at start"), (2000, "in"), (3000, "]"), (3000, "at end"), (3001, "after")])
+	zones = skip_zones((entry.offset, entry.text) for entry in comments)
+	assert zones == [(1000, 3000)]
+	assert [comments[i].text for i in kept_indices(comments, zones)] == ["before", "after"]
+
+def test_cut_zones():
+	assert cut_zones([(0, None, 1)], []) == [(0, None, 1)]
+	assert cut_zones([(0, None, 1)], [(1, 2), (3, 4)]) == [(0, 1, 1), (2, 3, 1), (4, None, 1)]
+	# A zone spanning two segments cuts the end of one and the start of the other
+	assert cut_zones([(0, 2, 1), (2, None, 2)], [(1, 3)]) == [(0, 1, 1), (3, None, 2)]
+	# A zone covering a whole segment removes it
+	assert cut_zones([(0, 1, 1), (1, 2, 2), (2, None, 1)], [(0.5, 2.5)]) == [(0, 0.5, 1), (2.5, None, 1)]
+	# Zones at the very start
+	assert cut_zones([(0, None, 1)], [(0, 1)]) == [(1, None, 1)]
+
+def test_compile_plan_zone_spanning_a_speed_change():
+	plan = compile_plan([(0, "a"), (1000, "["), (1500, ">>"), (2000, "in"), (3000, "]"), (4000, "after")])
+	assert plan.speed_changes == [(1500, 2)]
+	assert plan.skip_zones == [(1000, 3000)]
+	# The speed set inside the zone applies after it
+	assert plan.segments == [(0, 1.0, 1), (3.0, None, 2)]
+	assert [(entry.offset, entry.text) for entry in plan.adjusted] == [(0.0, "a"), (1500.0, "after")]
+
+def test_compile_plan_speed_changes():
+	plan = compile_plan([(0, "a"), (1000, ">>"), (3000, "b"), (5000, "<<"), (6000, "c")])
+	assert plan.segments == [(0, 1.0, 1), (1.0, 5.0, 2), (5.0, None, 0.5)]
+	offsets = {entry.text: entry.offset for entry in plan.adjusted}
+	assert offsets == {"a": 0.0, ">>": 1000.0, "b": 2000.0, "<<": 3000.0, "c": 5000.0}
+
+def test_comment_timeline_lookups_at_edges():
+	timeline = CommentTimeline(entries([(0, "a"), (1000, ">>"), (2000, "["), (2000, "x"), (3000, "]"), (4000, "<<")]))
+	assert timeline.find(2000) == 2
+	assert timeline.find(2500) is None
+	# Comments at the position have been shown already
+	assert timeline.next_row(1999) == 2
+	assert timeline.next_row(2000) == 4
+	assert timeline.insert_row(2000) == 4
+	# A speed comment applies from its own offset
+	assert timeline.speed_at(999) == 1
+	assert timeline.speed_at(1000) == 2
+	assert timeline.speed_at(4000) == 0.5
+	# A zone starts at its "[" and ends at its "]"
+	assert timeline.skip_end(1999) is None
+	assert timeline.skip_end(2000) == 3000
+	assert timeline.skip_end(2999) == 3000
+	assert timeline.skip_end(3000) is None
+	assert timeline.zone_end(2000) == 3000
+	assert timeline.zone_end(3000) is None
+
+def test_comment_timeline_edits():
+	timeline = CommentTimeline(entries([(0, "a"), (1000, "["), (3000, "]")]))
+	assert timeline.skip_end(2000) == 3000
+	# A second "[" inside the zone restarts it
+	row = timeline.insert_row(2000)
+	timeline.insert(row, compile_comment(2000, "["))
+	assert timeline.skip_end(1500) is None
+	assert timeline.skip_end(2500) == 3000
+	timeline.remove(row)
+	assert timeline.skip_end(1500) == 3000
+	# Moving the "]" moves the end of the zone
+	timeline.move(2, 4000)
+	assert timeline.skip_end(3500) == 4000
+	# Replacing a comment's text updates the speed marks
+	timeline.replace(0, ">>>")
+	assert timeline.speed_at(0) == 3
+	timeline.replace(0, "a")
+	assert timeline.speed_at(0) == 1
+	assert timeline.plan().skip_zones == [(1000, 4000)]
@@ -0,0 +1,74 @@
+import re, sys, json, time, threading
+from functools import lru_cache
+
+# Check if string is alphabetic
+ALPHA_REG = re.compile(r'^[a-zA-Z]+$')
+
+# MeCab taggers are expensive to build, so one is shared by every caller
+_tagger = None
+_tagger_lock = threading.Lock()
+
+def _get_tagger():
+	# MeCab and its dictionary are loaded on first use, not when the module is imported
+	global _tagger
+	if _tagger is None:
+		import MeCab
+		_tagger = MeCab.Tagger('-Owakati')
+	return _tagger
+
+def wakati(text):
+	with _tagger_lock:
+		return _get_tagger().parse(text)
+
+@lru_cache(maxsize=8192)
+def word_to_kana(word):
+	import alkana
+	return alkana.get_kana(word)
+
+def english_words(wakati_result):
+	words = []
+	for word in wakati_result.split():
+		if ALPHA_REG.match(word) and word not in words:
+			words.append(word)
+	return words
+
+def replace_words(text, words):
+	# Replace every English word with its reading (or drop it when alkana has none) in a single pass
+	if not words:
+		return text
+	pattern = re.compile("|".join(re.escape(word) for word in sorted(words, key=len, reverse=True)))
+	return pattern.sub(lambda match: word_to_kana(match.group(0)) or "", text)
+
+# Helper function: Convert alphabet to Katakana
+# https://qiita.com/kunishou/items/814e837cf504ce287a13
+def alpha_to_kana(text):
+	return replace_words(text, english_words(wakati(text)))
+
+def alpha_to_kana_batch(texts):
+	# Normalize a whole comment list, tokenizing under a single lock acquisition
+	with _tagger_lock:
+		tagger = _get_tagger()
+		tokenized = [tagger.parse(text) for text in texts]
+	return [replace_words(text, english_words(result)) for text, result in zip(texts, tokenized)]
+
+if __name__ == "__main__":
+	# Measure throughput: python textnorm.py <video>.comments.json [repeat]
+	with open(sys.argv[1], "r") as f:
+		comments = json.load(f)
+	if isinstance(comments, dict):
+		comments = comments["comments"]
+	texts = [text for _, text in comments]
+	repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+	start = time.perf_counter()
+	for _ in range(repeat):
+		for text in texts:
+			alpha_to_kana(text)
+	elapsed = time.perf_counter() - start
+	print("alpha_to_kana: %.1f comments/sec" % (len(texts) * repeat / elapsed))
+
+	start = time.perf_counter()
+	for _ in range(repeat):
+		alpha_to_kana_batch(texts)
+	elapsed = time.perf_counter() - start
+	print("alpha_to_kana_batch: %.1f comments/sec" % (len(texts) * repeat / elapsed))
@@ -0,0 +1,324 @@
+import os, re, json, hashlib
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+# Bump when the compiled form of a comment or of the plan changes so that cached plans are compiled again
+PLAN_VERSION = 2
+DEFAULT_CACHE_DIR = os.environ.get("COMMENTPLAYER_PLAN_CACHE",
+	os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "commentplayer", "plans"))
+DEFAULT_CACHE_SIZE = int(os.environ.get("COMMENTPLAYER_PLAN_CACHE_SIZE", 64 * 1024 * 1024))
+
+# A comment with its directives parsed: {literal|reading} resolved for the display and the speech, the speed
+# set by a ">>" / "<<" comment (None for others) and the (display, speech) parts split at "---"
+CommentEntry = namedtuple("CommentEntry", "offset text display speech speed parts")
+# speed_changes: [(offset ms, speed)], skip_zones: [(start ms, end ms)],
+# segments: [(source start sec, source end sec or None for the rest of the video, speed)] without the skipped zones,
+# adjusted: the comments that are not skipped, with their offsets moved onto the output timeline
+TimelinePlan = namedtuple("TimelinePlan", "entries speed_changes skip_zones segments adjusted")
+
+READING_REG = re.compile(r'\{([^|]+)\|([^}]+)\}')
+FAST_FORWARD_REG = re.compile(r'^>+(\n)*$')
+SLOW_DOWN_REG = re.compile(r'^<+(\n)*$')
+
+def display_text(text):
+	return READING_REG.sub(r'\1', text) if '{' in text else text
+
+def speech_text(text):
+	return READING_REG.sub(r'\2', text) if '{' in text else text
+
+def comment_speed(text):
+	# Playback speed set by a ">>" or "<<" comment, None for any other comment
+	fast_forward_match = FAST_FORWARD_REG.match(text)
+	if fast_forward_match:
+		return len(fast_forward_match.group(0).replace('\n', ''))
+	slow_down_match = SLOW_DOWN_REG.match(text)
+	if slow_down_match:
+		return 1.0 / len(slow_down_match.group(0).replace('\n', ''))
+	return None
+
+def compile_comment(offset, text):
+	parts = tuple((display_text(part), speech_text(part)) for part in text.split('---') if len(part.strip()) > 0)
+	return CommentEntry(offset, text, display_text(text), speech_text(text), comment_speed(text), parts)
+
+def skip_zones(comments):
+	# [(start ms, end ms)] skipped by the player: a "[" pairs with the next "]" unless another "[" comes first
+	zones = []
+	start = None
+	for offset, text in comments:
+		if text == "[":
+			start = offset
+		elif text == "]" and start is not None:
+			zones.append((start, offset))
+			start = None
+	return zones
+
+def cut_zones(segments, zones):
+	# Remove the skipped zones (sec, sorted) from [(start sec, end sec or None, speed)], sweeping both lists once
+	pieces = []
+	i = 0
+	for start_s, end_s, speed in segments:
+		while i < len(zones) and zones[i][1] <= start_s:
+			i += 1
+		current = start_s
+		for zone_start, zone_end in zones[i:]:
+			if end_s is not None and zone_start >= end_s:
+				break
+			if zone_start > current:
+				pieces.append((current, zone_start, speed))
+			current = max(current, zone_end)
+		if end_s is None or current < end_s:
+			pieces.append((current, end_s, speed))
+	return pieces
+
+def output_time(segments, t):
+	# Position on the output timeline of source time t (sec)
+	out_time = 0
+	for start_s, end_s, speed in segments:
+		if end_s is None or t < end_s:
+			return out_time + max(0, t - start_s) / speed
+		out_time += (end_s - start_s) / speed
+	return out_time
+
+def kept_indices(entries, zones):
+	# Indices of the comments that are shown: the bracket marks and the comments in skipped zones are dropped
+	zone_starts = [start for start, _ in zones]
+	for i, entry in enumerate(entries):
+		j = bisect_right(zone_starts, entry.offset) - 1
+		if entry.text not in ("[", "]") and (j < 0 or entry.offset > zones[j][1]):
+			yield i
+
+def kept_entries(entries, zones):
+	return (entries[i] for i in kept_indices(entries, zones))
+
+def compile_plan(comments):
+	# comments: [(offset ms, text)] in timeline order, or CommentEntry already compiled
+	entries = [comment if isinstance(comment, CommentEntry) else compile_comment(*comment) for comment in comments]
+	# Speed changes inside a skipped zone still apply after it, as in the player
+	speed_changes = [(entry.offset, entry.speed) for entry in entries if entry.speed is not None]
+
+	segments = []
+	current_speed = 1
+	current_time = 0
+	for offset, speed in speed_changes:
+		start_s = offset / 1000.0
+		if speed != current_speed:
+			if current_time != start_s:
+				segments.append((current_time, start_s, current_speed))
+			current_speed = speed
+			current_time = start_s
+	# The remaining part of the video runs at the last speed
+	segments.append((current_time, None, current_speed))
+
+	zones = skip_zones((entry.offset, entry.text) for entry in entries)
+	segments = cut_zones(segments, [(start / 1000.0, end / 1000.0) for start, end in zones])
+
+	# The others are shifted by the cut and retimed footage before them
+	segment_ends = [end_s for _, end_s, _ in segments[:-1]]
+	segment_outs = [0]  # output time at the start of each segment
+	for start_s, end_s, speed in segments[:-1]:
+		segment_outs.append(segment_outs[-1] + (end_s - start_s) / speed)
+	adjusted = []
+	for entry in kept_entries(entries, zones):
+		t = entry.offset / 1000.0
+		j = bisect_right(segment_ends, t)
+		start_s, _, speed = segments[j]
+		adjusted.append(entry._replace(offset=(segment_outs[j] + max(0, t - start_s) / speed) * 1000))
+	return TimelinePlan(entries, speed_changes, zones, segments, adjusted)
+
+def plan_to_json(plan):
+	# Adjusted comments are stored as (index in entries, output offset)
+	return {"version": PLAN_VERSION, "entries": plan.entries, "speed_changes": plan.speed_changes,
+			"skip_zones": plan.skip_zones, "segments": plan.segments,
+			"adjusted": [(i, entry.offset) for i, entry in zip(kept_indices(plan.entries, plan.skip_zones), plan.adjusted)]}
+
+def plan_from_json(data):
+	# Parts are left as lists: they are only iterated
+	entries = [CommentEntry._make(row) for row in data["entries"]]
+	return TimelinePlan(entries, [tuple(change) for change in data["speed_changes"]],
+						[tuple(zone) for zone in data["skip_zones"]], [tuple(segment) for segment in data["segments"]],
+						[entries[i]._replace(offset=offset) for i, offset in data["adjusted"]])
+
+class PlanCache:
+	# Compiled plans as JSON files, keyed by the content of the comment list they were compiled from. Least recently
+	# used plans are deleted once the cache grows past max_bytes.
+	def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		os.makedirs(directory, exist_ok=True)
+
+	def key(self, comments):
+		source = json.dumps([PLAN_VERSION, [[offset, text] for offset, text, *_ in comments]], ensure_ascii=False, separators=(",", ":"))
+		return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key[:2], key + ".json")
+
+	def get(self, key):
+		path = self.path(key)
+		try:
+			with open(path, "r", encoding="utf-8") as f:
+				data = json.load(f)
+			os.utime(path)  # mtime doubles as the LRU timestamp
+			if data.get("version") != PLAN_VERSION:
+				return None
+			return plan_from_json(data)
+		except (OSError, ValueError, KeyError, TypeError):
+			return None
+
+	def put(self, key, plan):
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		temp_path = "%s.%d.tmp" % (path, os.getpid())
+		with open(temp_path, "w", encoding="utf-8") as f:
+			json.dump(plan_to_json(plan), f, ensure_ascii=False)
+		os.replace(temp_path, path)
+		self.evict(keep=path)
+
+	def evict(self, keep=None):
+		found = []
+		for root, _, files in os.walk(self.directory):
+			for name in files:
+				if name.endswith(".json"):
+					path = os.path.join(root, name)
+					try:
+						st = os.stat(path)
+					except OSError:
+						continue  # Evicted by another process meanwhile
+					found.append((st.st_mtime, path, st.st_size))
+		total = sum(size for _, _, size in found)
+		for _, path, size in sorted(found):
+			if total <= self.max_bytes:
+				break
+			if path != keep:
+				try:
+					os.unlink(path)
+				except OSError:
+					pass
+				total -= size
+
+_default_cache = None
+
+def default_cache():
+	global _default_cache
+	if _default_cache is None:
+		_default_cache = PlanCache()
+	return _default_cache
+
+def load_plan(comments, cache=None):
+	# The compiled plan of a comment list, from the cache when it was compiled before (the player stores it on save)
+	cache = cache or default_cache()
+	key = cache.key(comments)
+	plan = cache.get(key)
+	if plan is None:
+		plan = compile_plan(comments)
+		cache.put(key, plan)
+	return plan
+
+class CommentTimeline:
+	# Index kept next to the player's comment list, which is sorted by offset: the compiled comments, the offsets
+	# for bisect lookups, the speed changes and the "[" ... "]" skip zones. Rows are inserted and removed one at a time
+	# as comments are edited, so each comment is compiled once per edit.
+	def __init__(self, entries=()):
+		self.reset(entries)
+
+	def reset(self, entries):
+		self.entries = list(entries)
+		self.offsets = [entry.offset for entry in self.entries]
+		self.speed_offsets, self.speeds = [], []
+		self.bracket_offsets, self.brackets = [], []
+		for entry in self.entries:
+			self.add_marks(entry, update=False)
+		self.update_zones()
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def insert_row(self, position):
+		# Row a new comment at this position goes to: after the comments at the same offset
+		return bisect_right(self.offsets, position)
+
+	def insert(self, row, entry):
+		self.entries.insert(row, entry)
+		self.offsets.insert(row, entry.offset)
+		self.add_marks(entry)
+
+	def remove(self, row):
+		self.offsets.pop(row)
+		self.remove_marks(self.entries.pop(row))
+
+	def move(self, row, offset):
+		# New offset for a row that keeps its place in the order
+		self.remove_marks(self.entries[row])
+		self.entries[row] = self.entries[row]._replace(offset=offset)
+		self.offsets[row] = offset
+		self.add_marks(self.entries[row])
+
+	def replace(self, row, text):
+		# Text of a row changed, its offset did not
+		self.remove_marks(self.entries[row])
+		self.entries[row] = compile_comment(self.offsets[row], text)
+		self.add_marks(self.entries[row])
+
+	def add_marks(self, entry, update=True):
+		if entry.speed is not None:
+			i = bisect_right(self.speed_offsets, entry.offset)
+			self.speed_offsets.insert(i, entry.offset)
+			self.speeds.insert(i, entry.speed)
+		if entry.text in ("[", "]"):
+			i = bisect_right(self.bracket_offsets, entry.offset)
+			self.bracket_offsets.insert(i, entry.offset)
+			self.brackets.insert(i, entry.text)
+			if update:
+				self.update_zones()
+
+	def remove_marks(self, entry):
+		if entry.speed is not None:
+			for i in range(bisect_left(self.speed_offsets, entry.offset), bisect_right(self.speed_offsets, entry.offset)):
+				if self.speeds[i] == entry.speed:
+					del self.speed_offsets[i], self.speeds[i]
+					break
+		if entry.text in ("[", "]"):
+			for i in range(bisect_left(self.bracket_offsets, entry.offset), bisect_right(self.bracket_offsets, entry.offset)):
+				if self.brackets[i] == entry.text:
+					del self.bracket_offsets[i], self.brackets[i]
+					break
+			self.update_zones()
+
+	def update_zones(self):
+		# Brackets are few, so the zone table is simply rebuilt
+		zones = skip_zones(zip(self.bracket_offsets, self.brackets))
+		self.zone_starts = [start for start, _ in zones]
+		self.zone_ends = [end for _, end in zones]
+
+	def find(self, position):
+		# Row of the comment at exactly this position, or None
+		i = bisect_left(self.offsets, position)
+		if i < len(self.offsets) and self.offsets[i] == position:
+			return i
+		return None
+
+	def next_row(self, position):
+		# First row after the position
+		return bisect_right(self.offsets, position)
+
+	def speed_at(self, position):
+		# Speed set by the last speed comment at or before the position
+		i = bisect_right(self.speed_offsets, position)
+		return self.speeds[i - 1] if i > 0 else 1
+
+	def skip_end(self, position):
+		# End of the skip zone the position is in, or None
+		i = bisect_right(self.zone_starts, position) - 1
+		if i >= 0 and position < self.zone_ends[i]:
+			return self.zone_ends[i]
+		return None
+
+	def zone_end(self, offset):
+		# End of the skip zone opened by a "[" at this offset, or None if it is not paired
+		i = bisect_left(self.zone_starts, offset)
+		if i < len(self.zone_starts) and self.zone_starts[i] == offset:
+			return self.zone_ends[i]
+		return None
+
+	def plan(self):
+		return compile_plan(self.entries)
@@ -0,0 +1,68 @@
+from bisect import bisect_left, bisect_right
+import numpy as np
+from PIL import Image, ImageDraw
+
+def stroke_segments(trajectory):
+	# Line segments (draw time, start time, x0, y0, x1, y1) between consecutive points of the same stroke, sorted by draw time
+	segments = []
+	prev_start_time = prev_x = prev_y = None
+	for start_time, draw_time, x, y in trajectory:
+		if prev_start_time == start_time and start_time is not None:
+			segments.append((draw_time, start_time, prev_x, prev_y, x, y))
+		prev_start_time, prev_x, prev_y = start_time, x, y
+	segments.sort(key=lambda s: s[0])
+	return segments
+
+def trajectory_window(trajectory, clear_events, start_ms, end_ms):
+	# Points of the strokes that can be visible between start_ms and end_ms: strokes with a point
+	# drawn after the last clear event before start_ms and no later than end_ms
+	clear_events = sorted(clear_events)
+	i = bisect_left(clear_events, start_ms)
+	last_clipped = clear_events[i - 1] if i > 0 else -1
+	visible = set(start_time for start_time, draw_time, _, _ in trajectory if last_clipped < draw_time <= end_ms)
+	return [point for point in trajectory if point[0] in visible]
+
+class TrajectoryRenderer:
+	# Draws the trajectory onto video frames, keeping a stroke layer between frames so that
+	# each frame only rasterizes the segments added since the previous one
+	def __init__(self, trajectory, clear_events, color=(255, 0, 0), width=3):
+		self.segments = stroke_segments(trajectory)
+		self.times = [s[0] for s in self.segments]
+		self.clear_events = sorted(clear_events)
+		self.color = np.array(color, dtype=np.uint8)
+		self.width = width
+		self.layer = None
+		self.size = None
+		self.lo = self.hi = 0  # segments[lo:hi] are drawn on the layer
+		self.pixels = None
+
+	def visible_range(self, t_ms):
+		# Segments drawn after the last clear event and up to t_ms
+		i = bisect_left(self.clear_events, t_ms)
+		last_clipped = self.clear_events[i - 1] if i > 0 else -1
+		return bisect_right(self.times, last_clipped), bisect_right(self.times, t_ms)
+
+	def render(self, frame, current_time):
+		if frame.ndim != 3:
+			return frame
+		lo, hi = self.visible_range(current_time * 1000)
+		if hi <= lo:
+			return frame  # No stroke visible: leave the frame untouched
+
+		height, width = frame.shape[:2]
+		if self.layer is None or self.size != (width, height) or lo != self.lo or hi < self.hi:
+			# Cleared, seeked backwards or resized: start a new layer
+			self.layer = Image.new("L", (width, height), 0)
+			self.size = (width, height)
+			self.lo = self.hi = lo
+		if hi > self.hi:
+			draw = ImageDraw.Draw(self.layer)
+			for _, _, prev_x, prev_y, x, y in self.segments[self.hi:hi]:
+				draw.line((prev_x * width + width / 2, prev_y * width + height / 2,
+						   x * width + width / 2, y * width + height / 2), fill=255, width=self.width)
+			self.hi = hi
+			self.pixels = np.nonzero(np.asarray(self.layer))
+
+		frame = frame.copy()
+		frame[self.pixels[0], self.pixels[1], :3] = self.color
+		return frame
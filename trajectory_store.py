@@ -0,0 +1,136 @@
+import os, sys, mmap, struct
+from array import array
+
+# Sidecar layout: magic, point count, then the four float64 columns (little endian) one after another
+SIDECAR_MAGIC = b"CPTRAJ01"
+SIDECAR_HEADER = struct.Struct("<8sQ")
+COLUMNS = ("start_times", "times", "xs", "ys")
+
+def sidecar_filename(comments_filename, sequence=None):
+	# Snapshots name their sidecar after the journal sequence they include
+	base = comments_filename[:-5] if comments_filename.endswith(".json") else comments_filename
+	if sequence is None:
+		return base + ".trajectory.bin"
+	return base + ".trajectory.%d.bin" % sequence
+
+def fsync_directory(path):
+	# Make a rename in this directory durable; not possible on every platform
+	try:
+		fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
+class TrajectoryStore:
+	# Trajectory points (start time, time, x, y) kept in typed columns instead of a list of tuples.
+	# Points are appended as they are captured and only sorted by start time when a reader needs it.
+	def __init__(self, points=()):
+		for name in COLUMNS:
+			setattr(self, name, array("d"))
+		self.sorted = True
+		self.extend(points)
+
+	def __len__(self):
+		return len(self.times)
+
+	def __getitem__(self, i):
+		self.ensure_sorted()
+		return (self.start_times[i], self.times[i], self.xs[i], self.ys[i])
+
+	def __iter__(self):
+		self.ensure_sorted()
+		return zip(self.start_times, self.times, self.xs, self.ys)
+
+	def own(self):
+		# Columns mapped from a sidecar are read-only until the first edit copies them
+		if not isinstance(self.times, array):
+			for name in COLUMNS:
+				setattr(self, name, array("d", getattr(self, name)))
+
+	def append(self, point):
+		start_time, time, x, y = point
+		if start_time is None:
+			return
+		self.own()
+		if len(self.start_times) > 0 and start_time < self.start_times[-1]:
+			self.sorted = False
+		self.start_times.append(start_time)
+		self.times.append(time)
+		self.xs.append(x)
+		self.ys.append(y)
+
+	def extend(self, points):
+		for point in points:
+			self.append(point)
+
+	def ensure_sorted(self):
+		if self.sorted:
+			return
+		# Stable sort, so that points of a stroke keep their capture order
+		order = sorted(range(len(self.start_times)), key=self.start_times.__getitem__)
+		for name in COLUMNS:
+			column = getattr(self, name)
+			setattr(self, name, array("d", (column[i] for i in order)))
+		self.sorted = True
+
+	def filter(self, predicate):
+		return TrajectoryStore(point for point in self if predicate(point))
+
+	def to_list(self):
+		return [list(point) for point in self]
+
+	def save(self, filename):
+		self.ensure_sorted()
+		temp_filename = filename + ".tmp"
+		with open(temp_filename, "wb") as f:
+			f.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, len(self)))
+			for name in COLUMNS:
+				column = array("d", getattr(self, name))
+				if sys.byteorder != "little":
+					column.byteswap()
+				column.tofile(f)
+			# On disk before a snapshot that refers to it is
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(temp_filename, filename)
+		fsync_directory(filename)
+
+	@classmethod
+	def load(cls, filename):
+		# Memory-map the sidecar; the columns are used in place until the store is edited
+		store = cls()
+		with open(filename, "rb") as f:
+			header = f.read(SIDECAR_HEADER.size)
+			if len(header) < SIDECAR_HEADER.size:
+				raise ValueError("%s is truncated" % filename)
+			magic, count = SIDECAR_HEADER.unpack(header)
+			if magic != SIDECAR_MAGIC:
+				raise ValueError("%s is not a trajectory sidecar" % filename)
+			# A sidecar cut short by a crash must not be mapped as if it held every point
+			if os.fstat(f.fileno()).st_size != SIDECAR_HEADER.size + count * 8 * len(COLUMNS):
+				raise ValueError("%s does not hold the %d points it records" % (filename, count))
+			if count == 0:
+				return store
+			mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		data = memoryview(mapped)
+		for i, name in enumerate(COLUMNS):
+			column = data[SIDECAR_HEADER.size + i * count * 8:SIDECAR_HEADER.size + (i + 1) * count * 8].cast("d")
+			if sys.byteorder != "little":
+				column = array("d", column)
+				column.byteswap()
+			setattr(store, name, column)
+		return store
+
+def load_trajectory(comments_filename, data):
+	# Read the trajectory of a .comments.json document: from its binary sidecar, or the inline JSON list of older files
+	trajectory_file = data.get("trajectory_file")
+	if trajectory_file:
+		path = os.path.join(os.path.dirname(comments_filename), trajectory_file)
+		if os.path.exists(path):
+			return TrajectoryStore.load(path)
+	return TrajectoryStore(data.get("trajectory", []))
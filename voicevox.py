@@ -0,0 +1,234 @@
+import os, json, time, struct, hashlib, threading, unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from metrics import current as current_metrics
+
+# Global variable for the hostname of the VOICEVOX server
+VOICEVOX_SERVER = os.environ.get("VOICEVOX_SERVER", "http://localhost:50021")
+
+# Synthesized speech is cached under ~/.cache/commentplayer/voicevox unless overridden
+DEFAULT_CACHE_DIR = os.environ.get("COMMENTPLAYER_VOICE_CACHE",
+	os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "commentplayer", "voicevox"))
+DEFAULT_CACHE_SIZE = int(os.environ.get("COMMENTPLAYER_VOICE_CACHE_SIZE", 512 * 1024 * 1024))
+# Bytes read at a time from a streamed /synthesis response
+STREAM_CHUNK_SIZE = 16 * 1024
+
+_engine_versions = {}
+_engine_versions_lock = threading.Lock()
+
+def new_session():
+	# A keep-alive connection for one thread; requests is only imported once something is synthesized
+	import requests
+	from requests.adapters import HTTPAdapter
+	session = requests.Session()
+	adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+	session.mount("http://", adapter)
+	session.mount("https://", adapter)
+	return session
+
+def engine_version(server=VOICEVOX_SERVER):
+	# Ask the engine once per process; a different engine build invalidates every cache entry.
+	# None while the engine does not answer: asked again on the next call instead of remembering the failure.
+	import requests
+	with _engine_versions_lock:
+		if server not in _engine_versions:
+			try:
+				res = requests.get(server + "/version", timeout=5)
+				_engine_versions[server] = str(res.json())
+			except (requests.RequestException, ValueError):
+				return None
+		return _engine_versions[server]
+
+def normalize_text(text):
+	return unicodedata.normalize("NFC", text).strip()
+
+class SynthesisCache:
+	# On-disk cache of synthesized WAV bytes, evicted least-recently-used first once max_bytes is exceeded
+	def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()  # key -> size, oldest first
+		self.total_bytes = 0
+		os.makedirs(directory, exist_ok=True)
+		self.scan()
+
+	def scan(self):
+		found = []
+		for root, _, files in os.walk(self.directory):
+			for name in files:
+				if not name.endswith(".wav"):
+					continue
+				st = os.stat(os.path.join(root, name))
+				found.append((st.st_mtime, name[:-4], st.st_size))
+		found.sort()
+		for _, key, size in found:
+			self.entries[key] = size
+			self.total_bytes += size
+
+	def key(self, text, speaker, speedScale, version):
+		source = json.dumps([normalize_text(text), speaker, round(float(speedScale), 6), version], ensure_ascii=False)
+		return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key[:2], key + ".wav")
+
+	def get(self, key):
+		with self.lock:
+			if key not in self.entries:
+				self.misses += 1
+				return None
+			path = self.path(key)
+			try:
+				with open(path, "rb") as f:
+					data = f.read()
+				os.utime(path)  # mtime doubles as the LRU timestamp across runs
+			except OSError:
+				self.total_bytes -= self.entries.pop(key)
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return data
+
+	def put(self, key, data):
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+		with open(temp_path, "wb") as f:
+			f.write(data)
+		os.replace(temp_path, path)
+		with self.lock:
+			self.total_bytes -= self.entries.pop(key, 0)
+			self.entries[key] = len(data)
+			self.total_bytes += len(data)
+			self.evict()
+
+	def evict(self):
+		while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+			key, size = self.entries.popitem(last=False)
+			self.total_bytes -= size
+			self.evictions += 1
+			try:
+				os.unlink(self.path(key))
+			except OSError:
+				pass
+
+	def stats(self):
+		with self.lock:
+			return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+					"entries": len(self.entries), "bytes": self.total_bytes}
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def default_cache():
+	global _default_cache
+	with _default_cache_lock:
+		if _default_cache is None:
+			_default_cache = SynthesisCache()
+		return _default_cache
+
+def synthesize_stream(text, speaker=0, speedScale=1.0, cache=None, server=VOICEVOX_SERVER, session=None, chunk_size=STREAM_CHUNK_SIZE):
+	# Yields the WAV bytes for text as they arrive from the engine, or in one piece from the cache
+	if session is None:
+		import requests
+		session = requests
+	http = session
+	if cache is None:
+		cache = default_cache()
+	# Without the engine version the audio cannot be told apart from another build's: the cache is not used
+	version = engine_version(server) if cache else None
+	key = cache.key(text, speaker, speedScale, version) if version is not None else None
+	if key:
+		wav_data = cache.get(key)
+		if wav_data is not None:
+			yield wav_data
+			return
+
+	started = time.perf_counter()
+	res1 = http.post(server + "/audio_query", params={"text": text, "speaker": speaker})
+	data = res1.json()
+	if "speedScale" in data:
+		data["speedScale"] *= speedScale
+	wav_res = http.post(server + "/synthesis", params={"speaker": speaker}, json=data, stream=True)
+	wav_res.raise_for_status()
+	chunks = []
+	for chunk in wav_res.iter_content(chunk_size):
+		chunks.append(chunk)
+		yield chunk
+
+	current_metrics().sample("voicevox_ms", (time.perf_counter() - started) * 1000)
+	if key:
+		cache.put(key, b"".join(chunks))
+
+def synthesize(text, speaker=0, speedScale=1.0, cache=None, server=VOICEVOX_SERVER, session=None):
+	# Returns WAV bytes for text, going to /audio_query and /synthesis only on a cache miss
+	return b"".join(synthesize_stream(text, speaker, speedScale, cache, server, session))
+
+def parse_wav_header(data):
+	# (channels, sample rate, bytes per sample, offset of the samples) once data holds the whole header, None before
+	if len(data) < 12:
+		return None
+	if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+		raise ValueError("not a WAV stream")
+	pos = 12
+	fmt = None
+	while pos + 8 <= len(data):
+		chunk_id, size = struct.unpack_from("<4sI", data, pos)
+		if chunk_id == b"data":
+			if fmt is None:
+				raise ValueError("WAV stream without a fmt chunk")
+			return fmt + (pos + 8,)
+		if pos + 8 + size > len(data):
+			return None
+		if chunk_id == b"fmt ":
+			_, channels, rate, _, _, bits = struct.unpack_from("<HHIIHH", data, pos + 8)
+			fmt = (channels, rate, bits // 8)
+		pos += 8 + size + (size & 1)
+	return None
+
+class SynthesisPool:
+	# Bounded pool of synthesis workers, each holding its own keep-alive connection to the engine
+	def __init__(self, workers=4, cache=None, server=VOICEVOX_SERVER):
+		self.workers = max(1, int(workers))
+		self.cache = default_cache() if cache is None else cache
+		self.server = server
+		self.local = threading.local()
+		self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="voicevox")
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.shutdown()
+
+	def session(self):
+		session = getattr(self.local, "session", None)
+		if session is None:
+			session = self.local.session = new_session()
+		return session
+
+	def run(self, text, speaker, speedScale, prepare):
+		if prepare is not None:
+			text = prepare(text)
+		return synthesize(text, speaker, speedScale, self.cache, self.server, self.session())
+
+	def submit(self, text, speaker=0, speedScale=1.0, prepare=None):
+		return self.executor.submit(self.run, text, speaker, speedScale, prepare)
+
+	def map(self, texts, speaker=0, speedScale=1.0, prepare=None):
+		# Yields WAV bytes in input order while keeping at most a few requests per worker in flight
+		pending = deque()
+		for text in texts:
+			pending.append(self.submit(text, speaker, speedScale, prepare))
+			if len(pending) >= self.workers * 2:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+	def shutdown(self):
+		self.executor.shutdown(wait=True)